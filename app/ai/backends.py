@@ -0,0 +1,149 @@
+import asyncio
+import math
+import random
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Optional
+
+import openai
+
+from app.config import CONFIG
+
+
+class RateLimitError(Exception):
+    """
+    The provider refused the request because of its rate limit
+    """
+
+    def __init__(self, retry_after: Optional[float] = None):
+        self.retry_after = retry_after
+
+
+class LLMBackend(ABC):
+    """
+    Chat completion provider. Messages are OpenAI chat format dicts (role, content)
+    """
+
+    @abstractmethod
+    async def complete(self, messages: list[dict]) -> str:
+        ...
+
+    @abstractmethod
+    def stream(self, messages: list[dict]) -> AsyncIterator[str]:
+        """
+        :param messages:
+        :return: async iterator of content deltas
+        """
+        ...
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Fast local estimate of the token count. Tokenizers spend about four bytes of UTF-8 per token,
+        which keeps Cyrillic (two bytes per letter) and Latin text in proportion
+
+        :param text:
+        :return:
+        """
+        return len(text.encode("utf-8")) // 4 + 1
+
+
+class OpenAIBackend(LLMBackend):
+    def __init__(self, api_key: str = None, api_base: str = None, model: str = None):
+        self.api_key = api_key or CONFIG.gpt_api_key
+        self.api_base = api_base or CONFIG.gpt_api_base
+        self.model = model or CONFIG.gpt_model
+
+    async def _create(self, messages: list[dict], stream: bool = False):
+        try:
+            return await openai.ChatCompletion.acreate(
+                model=self.model,
+                messages=messages,
+                stream=stream,
+                api_key=self.api_key,
+                api_base=self.api_base
+            )
+        except openai.error.RateLimitError as e:
+            retry_after = (e.headers or {}).get("retry-after")
+            raise RateLimitError(float(retry_after) if retry_after else None)
+
+    async def complete(self, messages: list[dict]) -> str:
+        completion = await self._create(messages)
+        return completion.choices[0].message.content
+
+    async def stream(self, messages: list[dict]) -> AsyncIterator[str]:
+        async for chunk in await self._create(messages, stream=True):
+            delta = chunk.choices[0].delta.get("content")
+            if delta:
+                yield delta
+
+
+class Distribution:
+    """
+    Random variable given as "fixed:value", "uniform:low:high" or "lognormal:median:sigma"
+    """
+
+    def __init__(self, spec: str):
+        kind, *params = spec.split(":")
+        self.kind = kind
+        self.params = [float(param) for param in params]
+
+        if kind not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"Unknown distribution {spec}")
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return rng.uniform(*self.params)
+
+        median, sigma = self.params
+        return rng.lognormvariate(math.log(median), sigma)
+
+
+class StubBackend(LLMBackend):
+    """
+    Local stand-in for load tests: no network, model-like latency.
+
+    Every answer waits ``first_token`` ms, then produces ``words`` words ``token_delay`` ms apart.
+    The values are drawn from a seeded generator, so a run with the same requests is reproducible
+    """
+
+    def __init__(self, first_token: str = "lognormal:400:0.5", token_delay: str = "fixed:20",
+                 words: str = "uniform:20:120", seed: int = 0):
+        self.first_token = Distribution(first_token)
+        self.token_delay = Distribution(token_delay)
+        self.words = Distribution(words)
+        self.rng = random.Random(seed)
+
+    def _answer(self) -> tuple[float, float, list[str]]:
+        words = max(1, round(self.words.sample(self.rng)))
+        return (
+            self.first_token.sample(self.rng) / 1000,
+            self.token_delay.sample(self.rng) / 1000,
+            [f"слово{i} " for i in range(words)]
+        )
+
+    async def complete(self, messages: list[dict]) -> str:
+        first_token, token_delay, words = self._answer()
+        await asyncio.sleep(first_token + token_delay * (len(words) - 1))
+        return "".join(words)
+
+    async def stream(self, messages: list[dict]) -> AsyncIterator[str]:
+        first_token, token_delay, words = self._answer()
+        await asyncio.sleep(first_token)
+
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(token_delay)
+            yield word
+
+
+def create_backend() -> LLMBackend:
+    if CONFIG.llm_backend == "stub":
+        return StubBackend(
+            first_token=CONFIG.llm_stub_first_token,
+            token_delay=CONFIG.llm_stub_token_delay,
+            words=CONFIG.llm_stub_words,
+            seed=CONFIG.llm_stub_seed
+        )
+
+    return OpenAIBackend()
@@ -0,0 +1,76 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from app.config import CONFIG
+from app.metrics import metrics
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Case, spacing and the punctuation around the prompt do not change the answer
+    to greetings and small talk
+
+    :param prompt:
+    :return:
+    """
+    return " ".join(prompt.lower().split()).strip(" .,!?…")
+
+
+def cache_key(messages: list[dict]) -> str:
+    """
+    The normalized question plus a fingerprint of everything before it (system prompt and history),
+    so an answer is reused only for exactly the same context
+
+    :param messages: chat completion messages, the question last
+    :return:
+    """
+    *context, question = messages
+    fingerprint = json.dumps(context, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(f"{fingerprint}\0{normalize_prompt(question['content'])}".encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Size-bounded LRU of completions with a TTL
+    """
+
+    def __init__(self, size: int = 10000, ttl: float = 3600):
+        self.size = size
+        self.ttl = ttl
+        self._answers: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._hits = 0
+        self._lookups = 0
+
+    def _observe(self, hit: bool) -> None:
+        self._lookups += 1
+        self._hits += hit
+
+        metrics.counter("gpt.cache.hits" if hit else "gpt.cache.misses").inc()
+        metrics.gauge("gpt.cache.hit_rate").set(self._hits / self._lookups)
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._answers.get(key)
+
+        if entry and entry[0] < time.monotonic():
+            del self._answers[key]
+            entry = None
+
+        self._observe(entry is not None)
+        if entry is None:
+            return None
+
+        self._answers.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: str, answer: str) -> None:
+        self._answers[key] = (time.monotonic() + self.ttl, answer)
+        self._answers.move_to_end(key)
+
+        while len(self._answers) > self.size:
+            self._answers.popitem(last=False)
+
+
+responses = ResponseCache(size=CONFIG.gpt_cache_size, ttl=CONFIG.gpt_cache_ttl)
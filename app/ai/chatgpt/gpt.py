@@ -1,13 +1,15 @@
-from typing import Literal
+from typing import AsyncIterator, Literal, NamedTuple
 
-import openai
+from beanie import PydanticObjectId
 
 import app.chat.chat as chat
-import pymongo
+from app.ai.backends import create_backend
+from app.ai.chatgpt.cache import cache_key, responses
 from app.auth.models.user import User
 from app.config import CONFIG
+from app.metrics import metrics
 
-openai.api_key = CONFIG.gpt_api_key
+backend = create_backend()
 
 gpt_define = {"role": "system", "content": "Ты Ника. Ты голосовой помощник. Ты женского пола. тебя создала компания NNAI. Общайся со мной как с другом. А меня зовут {0}"}
 
@@ -23,36 +25,106 @@ async def generate_options(user: User) -> dict[Literal["role"] | Literal["conten
     return options
 
 
-async def ask(user: User, prompt: str) -> str:
-    completion = await openai.ChatCompletion.acreate(
-        model=CONFIG.gpt_model,
-        messages=[await generate_options(user), await transform_prompt(prompt)]
-    )
+async def complete(messages: list[dict]) -> str:
+    key = cache_key(messages) if CONFIG.gpt_cache else None
+    if key and (answer := responses.get(key)) is not None:
+        return answer
 
-    return completion.choices[0].message.content
+    answer = await backend.complete(messages)
 
+    if key:
+        responses.put(key, answer)
 
-async def ask_with_context(user: User, prompt: str) -> str:
-    last_user_msg = await chat.Message.find_one(chat.Message.user.id == user.id,
-                                                chat.Message.role == "user",
-                                                sort=[("_id", pymongo.DESCENDING)])
-    last_bot_msg = await chat.Message.find_one(chat.Message.user.id == user.id,
-                                               chat.Message.role == "assistant",
-                                               sort=[("_id", pymongo.DESCENDING)])
+    return answer
+
+
+async def stream(messages: list[dict]) -> AsyncIterator[str]:
+    """
+    Yields the completion as it is generated
+
+    :param messages:
+    :return: content deltas, a cached answer comes as one delta
+    """
+    key = cache_key(messages) if CONFIG.gpt_cache else None
+    if key and (answer := responses.get(key)) is not None:
+        yield answer
+        return
+
+    deltas = []
+    async for delta in backend.stream(messages):
+        deltas.append(delta)
+        yield delta
+
+    # Only complete answers are cached, an abandoned stream never gets here
+    if key:
+        responses.put(key, "".join(deltas))
+
+
+# Per-message overhead of the chat format, in tokens
+MESSAGE_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return backend.count_tokens(text)
+
+
+class ContextWindow(NamedTuple):
+    messages: list[dict]
+    tokens: int
+    # Turns that did not fit into the budget, oldest first
+    dropped: list[PydanticObjectId]
 
-    messages = [await generate_options(user)]
 
-    if last_user_msg and last_bot_msg:
-        messages.append(await transform_prompt(last_user_msg.content))
-        messages.append({"role": "assistant", "content": last_bot_msg.content})
+async def build_context(user: User, prompt: str, budget: int = None) -> ContextWindow:
+    """
+    Packs the newest turns of the conversation between the system prompt and the question,
+    as many as fit into the token budget
 
-    messages.append(await transform_prompt(prompt))
+    :param user:
+    :param prompt:
+    :param budget: estimated prompt size, CONFIG.gpt_context_tokens by default
+    :return:
+    """
+    budget = budget or CONFIG.gpt_context_tokens
+    turns = await chat.get_last_turns(user)
 
-    completion = await openai.ChatCompletion.acreate(
-        model=CONFIG.gpt_model,
-        messages=messages
-    )
+    # The prompt itself is usually stored before the question is asked
+    if turns and turns[-1].role == "user" and turns[-1].content == prompt:
+        turns = turns[:-1]
+
+    system = await generate_options(user)
+    question = await transform_prompt(prompt)
+    tokens = estimate_tokens(system["content"]) + estimate_tokens(prompt) + 2 * MESSAGE_TOKENS
+
+    history = []
+    for i in range(len(turns) - 1, -1, -1):
+        cost = estimate_tokens(turns[i].content) + MESSAGE_TOKENS
+        if tokens + cost > budget:
+            break
+
+        tokens += cost
+        history.append({"role": turns[i].role, "content": turns[i].content})
+    else:
+        i = -1
+
+    history.reverse()
+    dropped = [turn.id for turn in turns[:i + 1]]
+
+    if dropped:
+        metrics.counter("gpt.context.dropped_turns").inc(len(dropped))
+    metrics.summary("gpt.context.tokens").observe(tokens)
+
+    return ContextWindow([system, *history, question], tokens, dropped)
+
+
+async def ask(user: User, prompt: str) -> str:
+    return await complete([await generate_options(user), await transform_prompt(prompt)])
+
+
+async def ask_with_context(user: User, prompt: str) -> str:
+    return await complete((await build_context(user, prompt)).messages)
 
-    messages.clear()
 
-    return completion.choices[0].message.content
+async def ask_with_context_stream(user: User, prompt: str) -> AsyncIterator[str]:
+    async for delta in stream((await build_context(user, prompt)).messages):
+        yield delta
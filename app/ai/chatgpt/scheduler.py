@@ -0,0 +1,227 @@
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from beanie import PydanticObjectId
+
+from app.auth.models.user import User
+from app.config import CONFIG
+from app.metrics import metrics
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: Optional[float]):
+        # None - the tariff allows no requests at all
+        self.retry_after = retry_after
+
+    def __str__(self):
+        if self.retry_after is None:
+            return "Requests are not allowed"
+        return f"Too many requests, retry in {self.retry_after:.0f} s"
+
+
+def parse_rate_limits(limits: str) -> dict[str, float]:
+    """
+    :param limits: "tariff=requests per minute" pairs, e.g. "free=6,default=30". 0 disables the requests
+    :return: tariff -> requests per second
+    :raises ValueError: malformed pair, negative rate or no "default" rate
+    """
+    rates = {}
+    for pair in limits.split(","):
+        try:
+            tariff, per_minute = pair.split("=")
+            rate = float(per_minute) / 60
+        except ValueError:
+            raise ValueError(f"Incorrect rate limit {pair!r}, expected tariff=requests per minute")
+
+        if rate < 0:
+            raise ValueError(f"Incorrect rate limit {pair!r}, the rate can not be negative")
+
+        rates[tariff.strip()] = rate
+
+    if "default" not in rates:
+        raise ValueError(f"Rate limits {limits!r} have no default rate")
+
+    return rates
+
+
+class TokenBucket:
+    """
+    Requests allowed at ``rate`` per second with bursts of up to ``capacity``.
+    Reservations may overdraw the bucket, the debt is the delay of the request
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now: float, max_delay: float) -> float:
+        """
+        Take a token
+
+        :param now: monotonic time
+        :param max_delay: longest acceptable delay
+        :return: seconds until the token is available
+        :raises RateLimited: the delay would exceed ``max_delay`` or the rate is 0, nothing is taken
+        """
+        if self.rate <= 0:
+            raise RateLimited(None)
+
+        self._refill(now)
+        delay = max(0.0, (1 - self.tokens) / self.rate)
+
+        if delay > max_delay:
+            raise RateLimited(delay - max_delay)
+
+        self.tokens -= 1
+        return delay
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _UserQueue:
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        # asyncio.Lock wakes its waiters in FIFO order
+        self.lock = asyncio.Lock()
+        self.waiting = 0
+
+
+class Ticket:
+    def __init__(self, scheduler: "GPTScheduler", ready_at: float, enqueued: float):
+        self.scheduler = scheduler
+        self.ready_at = ready_at
+        self.enqueued = enqueued
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """
+        Wait for the rate limit and a free slot of the global pool, hold the slot for a request
+        """
+        delay = max(self.ready_at, self.scheduler.paused_until) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        async with self.scheduler.semaphore:
+            metrics.summary("gpt.scheduler.queue_seconds").observe(time.perf_counter() - self.enqueued)
+            self.scheduler.in_flight += 1
+            metrics.gauge("gpt.scheduler.in_flight").set(self.scheduler.in_flight)
+
+            try:
+                yield
+            finally:
+                self.scheduler.in_flight -= 1
+                metrics.gauge("gpt.scheduler.in_flight").set(self.scheduler.in_flight)
+
+
+class GPTScheduler:
+    """
+    Dispatch of ChatGPT requests.
+
+    Every user has a token bucket sized by the tariff and a FIFO queue: the turns of a user
+    (question, answer) run one after another. Requests of all users share a pool of
+    ``concurrency`` slots. A request that would wait longer than ``max_wait`` for its rate limit
+    is rejected up front, and an upstream 429 pauses the pool instead of being repeated by every
+    waiting request.
+    """
+
+    def __init__(self, concurrency: int = 16, rates: dict[str, float] = None, burst: int = 3,
+                 max_wait: float = 30, max_users: int = 10000):
+        self.rates = rates or {"default": 0.5}
+        self.burst = burst
+        self.max_wait = max_wait
+        self.max_users = max_users
+
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        # In the order of the last request, the least recently active users are pruned first
+        self._users: OrderedDict[PydanticObjectId, _UserQueue] = OrderedDict()
+
+    def _rate(self, tariff: Optional[str]) -> float:
+        return self.rates.get(tariff, self.rates["default"])
+
+    def _queue(self, user: User, now: float) -> _UserQueue:
+        queue = self._users.get(user.id)
+        rate = self._rate(user.tariff)
+
+        if queue is None:
+            if len(self._users) >= self.max_users:
+                self._prune(now)
+            if len(self._users) >= self.max_users:
+                # Every tracked user has requests in the queue
+                raise RateLimited(self.max_wait)
+            queue = self._users[user.id] = _UserQueue(TokenBucket(rate, self.burst))
+        else:
+            self._users.move_to_end(user.id)
+
+        # The tariff may have changed since the last request
+        queue.bucket.rate = rate
+        return queue
+
+    def _prune(self, now: float) -> None:
+        # Idle users with a full bucket have no state worth keeping
+        for user_id, queue in list(self._users.items()):
+            if not queue.waiting and queue.bucket.full(now):
+                del self._users[user_id]
+
+        # Then the least recently active idle users, their bucket debt is forgiven
+        for user_id, queue in list(self._users.items()):
+            if len(self._users) < self.max_users:
+                break
+            if not queue.waiting:
+                del self._users[user_id]
+
+    @asynccontextmanager
+    async def turn(self, user: User) -> AsyncIterator[Ticket]:
+        """
+        Reserve a request of the user and wait for the user's previous turns to finish
+
+        :param user:
+        :return: ticket, the request itself is made in ``ticket.slot()``
+        :raises RateLimited:
+        """
+        now = time.monotonic()
+        enqueued = time.perf_counter()
+
+        try:
+            queue = self._queue(user, now)
+            delay = queue.bucket.reserve(now, self.max_wait)
+        except RateLimited:
+            metrics.counter("gpt.scheduler.rejected").inc()
+            raise
+
+        queue.waiting += 1
+        try:
+            async with queue.lock:
+                yield Ticket(self, now + delay, enqueued)
+        finally:
+            queue.waiting -= 1
+
+    def pause(self, seconds: float) -> None:
+        """
+        Hold the requests that have not started yet, after the upstream rate limit was hit
+
+        :param seconds:
+        :return:
+        """
+        metrics.counter("gpt.scheduler.upstream_limited").inc()
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+gpt_scheduler = GPTScheduler(
+    concurrency=CONFIG.gpt_concurrency,
+    rates=parse_rate_limits(CONFIG.gpt_rate_limits),
+    burst=CONFIG.gpt_rate_burst,
+    max_wait=CONFIG.gpt_max_wait
+)
@@ -0,0 +1,70 @@
+from typing import Optional
+
+from beanie import PydanticObjectId
+
+from app.auth.models.user import User
+
+
+class UserContext:
+    """
+    Per-connection cache of authenticated users.
+
+    A user is bound to a sid when the socket authenticates (connect or auth_confirm)
+    and is served from memory for every following event of that socket.
+    """
+
+    def __init__(self):
+        self._users: dict[str, User] = {}
+        self._sids: dict[PydanticObjectId, set[str]] = {}
+
+    def bind(self, sid: str, user: User) -> None:
+        """
+        Bind an authenticated user to a socket
+
+        :param sid:
+        :param user:
+        :return:
+        """
+        self.unbind(sid)
+        self._users[sid] = user
+        self._sids.setdefault(user.id, set()).add(sid)
+
+    def unbind(self, sid: str) -> None:
+        """
+        Forget the user bound to a socket (logout, disconnect)
+
+        :param sid:
+        :return:
+        """
+        user = self._users.pop(sid, None)
+        if not user:
+            return
+
+        sids = self._sids.get(user.id)
+        if sids:
+            sids.discard(sid)
+            if not sids:
+                del self._sids[user.id]
+
+    def get(self, sid: str) -> Optional[User]:
+        return self._users.get(sid)
+
+    def update(self, user: User) -> None:
+        """
+        Replace the cached document on every socket of the user after the document has changed
+
+        :param user: fresh user document
+        :return:
+        """
+        for sid in self._sids.get(user.id, ()):
+            self._users[sid] = user
+
+    def invalidate(self, user_id: PydanticObjectId) -> None:
+        """
+        Drop the cached document on every socket of the user. The next event reloads it from the database
+
+        :param user_id:
+        :return:
+        """
+        for sid in self._sids.pop(user_id, ()):
+            self._users.pop(sid, None)
@@ -1,6 +1,7 @@
 from datetime import datetime
 
-from beanie import Document, Link
+import pymongo
+from beanie import Document, Link, Indexed
 from pydantic import BaseModel
 
 from app.auth.models.user import User
@@ -16,3 +17,23 @@ class TokensRead(BaseModel):
 
 class Tokens(Document, TokensRead):
     user: Link[User]
+
+    class Settings:
+        indexes = [
+            pymongo.IndexModel([("access_token", pymongo.ASCENDING)]),
+            pymongo.IndexModel([("refresh_token", pymongo.ASCENDING)]),
+            pymongo.IndexModel([("user.$id", pymongo.ASCENDING)]),
+        ]
+
+
+class RevokedToken(Document):
+    """
+    Revoked token id. Kept until the token itself expires
+    """
+    jti: Indexed(str, unique=True)
+    expire: datetime
+
+    class Settings:
+        indexes = [
+            pymongo.IndexModel([("expire", pymongo.ASCENDING)], expireAfterSeconds=0)
+        ]
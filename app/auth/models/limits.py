@@ -1,5 +1,6 @@
+import pymongo
 from beanie import Document
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, Field, validator
 from datetime import datetime, timedelta
 from app.auth.utils.checks import check_phone
 
@@ -7,13 +8,19 @@ from app.auth.utils.checks import check_phone
 class LimitRead(BaseModel):
     phone: str
     limit: int = 10
-    expire: datetime = datetime.utcnow() + timedelta(hours=1)
+    expire: datetime = Field(default_factory=lambda: datetime.utcnow() + timedelta(hours=1))
 
     # validators
     _check_phone = validator("phone", allow_reuse=True)(check_phone)
 
 
 class Limit(Document, LimitRead):
+    class Settings:
+        indexes = [
+            pymongo.IndexModel([("expire", pymongo.ASCENDING)], expireAfterSeconds=0),
+            pymongo.IndexModel([("phone", pymongo.ASCENDING)]),
+        ]
+
     @classmethod
     async def get_limit(cls, phone: str) -> "Limit":
         """
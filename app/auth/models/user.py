@@ -1,9 +1,10 @@
-import random
 import re
+import secrets
 import string
 from datetime import datetime, timedelta
 from typing import Optional
 
+import pymongo
 from beanie import Document, Indexed
 from pydantic import BaseModel, validator
 
@@ -33,6 +34,13 @@ class UserAuthCode(Document, UserAuthCodeInfo):
     """
     code: str
 
+    class Settings:
+        indexes = [
+            pymongo.IndexModel([("expire", pymongo.ASCENDING)], expireAfterSeconds=0),
+            pymongo.IndexModel([("code", pymongo.ASCENDING)]),
+            pymongo.IndexModel([("phone", pymongo.ASCENDING)]),
+        ]
+
     @classmethod
     async def get_by_phone(cls, phone: str) -> Optional["UserAuthCode"]:
         """
@@ -53,7 +61,7 @@ class UserUpdate(UserAuth):
 
 def generate_promocode(ln: int):
     letters = string.ascii_lowercase
-    return ''.join(random.choice(letters) for i in range(ln))
+    return ''.join(secrets.choice(letters) for i in range(ln))
 
 
 class UserRead(UserUpdate):
@@ -66,12 +74,6 @@ class UserRead(UserUpdate):
     # validators
     _check_phone = validator("phone", allow_reuse=True)(check_phone)
 
-    @validator("promocode")
-    def setup_promocode(cls, pc):
-        if not pc:
-            return generate_promocode(10)
-        return pc
-
 
 class User(Document, UserRead):
     phone: Indexed(str, unique=True)
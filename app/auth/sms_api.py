@@ -1,6 +1,9 @@
+import asyncio
+import random
 import re
+from typing import Optional
 
-import requests
+import aiohttp
 
 from app.config import CONFIG
 
@@ -29,12 +32,41 @@ def _check_phone(phone) -> bool:
     return True if len(str(phone)) <= 11 else False
 
 
-class SMSApi:
-    sms_server = "http://api.sms-prosto.ru"
+# Gateway answers that are safe to repeat: the message was not accepted. 502 and 504 of a proxy
+# in front of the gateway may come after the gateway has sent the message
+RETRY_STATUSES = {429, 503}
+
+
+class RequestInterrupted(aiohttp.ClientConnectionError):
+    """The connection broke after the request was sent, the gateway may have accepted it"""
+
 
-    def __init__(self, sender_name: str = "Nika"):
+async def no_resend(request: aiohttp.ClientRequest, handler) -> aiohttp.ClientResponse:
+    """
+    Client middleware. aiohttp sends an idempotent request once more when the connection breaks,
+    which could deliver an SMS twice. The error is raised as RequestInterrupted, which aiohttp does not repeat
+
+    :param request:
+    :param handler:
+    :return:
+    """
+    try:
+        return await handler(request)
+    except aiohttp.ClientConnectorError:
+        # Connect failures are not repeated by aiohttp, _request retries them
+        raise
+    except (aiohttp.ServerDisconnectedError, aiohttp.ClientOSError) as e:
+        raise RequestInterrupted(e.__str__()) from e
+
+
+class SMSApi:
+    def __init__(self, sender_name: str = "Nika", sms_server: str = None):
         self.key = CONFIG.sms_api_key
         self.name = sender_name
+        self.sms_server = sms_server or CONFIG.sms_server
+
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
 
     @classmethod
     async def validate_phone(cls, phone: str) -> bool:
@@ -45,6 +77,67 @@ class SMSApi:
                               phone)) \
                 and len(phone) <= 11
 
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """
+        Persistent session. Created lazily because it must be bound to the running event loop
+
+        :return:
+        """
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=CONFIG.sms_pool_size),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=CONFIG.sms_connect_timeout,
+                    sock_read=CONFIG.sms_read_timeout
+                ),
+                middlewares=(no_resend,)
+            )
+            self._semaphore = asyncio.Semaphore(CONFIG.sms_max_concurrency)
+
+        return self._session
+
+    async def close(self) -> None:
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    async def _request(self, params: dict) -> dict:
+        """
+        GET request to the gateway. Connect failures and overload answers are retried
+        with jittered exponential backoff. Errors after the request was sent (read timeouts,
+        dropped connections) are not retried: the message may already be sent
+
+        :param params:
+        :return: response json
+        """
+        session = await self._get_session()
+
+        for attempt in range(CONFIG.sms_retries + 1):
+            error = None
+
+            async with self._semaphore:
+                try:
+                    async with session.get(self.sms_server, params=params) as response:
+                        if response.status not in RETRY_STATUSES:
+                            response.raise_for_status()
+                            return await response.json(content_type=None)
+
+                        error = SMSBaseException(response.status, "SMS gateway is overloaded")
+                except (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError) as e:
+                    # The request was not sent
+                    error = SMSBaseException("connection", e.__str__())
+                except aiohttp.SocketTimeoutError:
+                    raise SMSBaseException("timeout", "SMS gateway did not respond")
+                except aiohttp.ClientConnectionError as e:
+                    raise SMSBaseException("connection", e.__str__())
+                except aiohttp.ClientResponseError as e:
+                    raise SMSBaseException(e.status, e.message)
+
+            if attempt < CONFIG.sms_retries:
+                await asyncio.sleep(random.uniform(0, CONFIG.sms_backoff * 2 ** attempt))
+
+        raise error
+
     async def send(self, phone: str, message: str, priority: int = 1) -> SMSResponse:
         """
         Sends the specified message to the specified phone number.
@@ -70,8 +163,7 @@ class SMSApi:
             "sender_name": self.name,
             "priority": priority
         }
-        payload = requests.get(self.sms_server, params=params)
-        raw = SMSResponse(data=payload.json())
+        raw = SMSResponse(data=await self._request(params))
 
         if int(raw.code) != 0:
             raise SMSBaseException(raw.code, raw.text)
@@ -0,0 +1,126 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+from app.auth.sms_api import SMSApi, SMSBaseException, SMSResponse
+from app.metrics import metrics
+
+# Share of worker picks per priority lane, see SMSApi.send for the meaning of priorities
+LANE_WEIGHTS = {1: 8, 2: 4, 3: 2, 4: 1}
+
+StatusCallback = Callable[["SMSJob"], Awaitable[None]]
+
+
+class SMSQueueFull(SMSBaseException):
+    def __init__(self, priority: int):
+        super().__init__("queue_full", f"SMS queue with priority {priority} is full, try again later")
+
+
+class SMSJob:
+    def __init__(self, phone: str, message: str, priority: int, on_status: Optional[StatusCallback] = None):
+        self.phone = phone
+        self.message = message
+        self.priority = priority
+        self.on_status = on_status
+
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.response: Optional[SMSResponse] = None
+        self.enqueued = time.perf_counter()
+
+
+class SMSDispatcher:
+    """
+    Background SMS delivery.
+
+    Every priority has its own bounded lane. Workers pick lanes by smooth weighted round robin,
+    so verification codes are served first without starving mailings, and a full lane rejects
+    new messages instead of growing without bound.
+    """
+
+    def __init__(self, api: SMSApi, workers: int = 4, lane_size: int = 1000, weights: dict[int, int] = None):
+        self.api = api
+        self.workers = workers
+        self.lane_size = lane_size
+        self.weights = weights or LANE_WEIGHTS
+
+        self._lanes: dict[int, deque[SMSJob]] = {priority: deque() for priority in self.weights}
+        self._credit: dict[int, int] = {priority: 0 for priority in self.weights}
+        self._pending = asyncio.Semaphore(0)
+        self._tasks: list[asyncio.Task] = []
+
+    def enqueue(self, phone: str, message: str, priority: int = 1,
+                on_status: Optional[StatusCallback] = None) -> SMSJob:
+        """
+        Put a message into the lane of its priority
+
+        :param phone:
+        :param message:
+        :param priority:
+        :param on_status: awaited with the job once it is sent or failed
+        :return: queued job
+        """
+        if priority not in self._lanes:
+            raise ValueError(f"Unknown SMS priority {priority}")
+
+        lane = self._lanes[priority]
+        if len(lane) >= self.lane_size:
+            metrics.counter(f"sms.lane{priority}.rejected").inc()
+            raise SMSQueueFull(priority)
+
+        job = SMSJob(phone, message, priority, on_status)
+        lane.append(job)
+        metrics.gauge(f"sms.lane{priority}.depth").set(len(lane))
+        self._pending.release()
+
+        return job
+
+    async def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+
+    def _next_job(self) -> SMSJob:
+        ready = [priority for priority, lane in self._lanes.items() if lane]
+
+        total = 0
+        for priority in self._lanes:
+            if priority not in ready:
+                self._credit[priority] = 0
+                continue
+            self._credit[priority] += self.weights[priority]
+            total += self.weights[priority]
+
+        priority = max(ready, key=lambda p: self._credit[p])
+        self._credit[priority] -= total
+
+        lane = self._lanes[priority]
+        job = lane.popleft()
+        metrics.gauge(f"sms.lane{priority}.depth").set(len(lane))
+
+        return job
+
+    async def _worker(self) -> None:
+        while True:
+            await self._pending.acquire()
+            job = self._next_job()
+            metrics.summary(f"sms.lane{job.priority}.wait_seconds").observe(time.perf_counter() - job.enqueued)
+
+            try:
+                job.response = await self.api.send(job.phone, job.message, job.priority)
+                job.status = "sent"
+            except Exception as e:
+                job.status = "failed"
+                job.error = e.__str__()
+
+            metrics.counter(f"sms.{job.status}").inc()
+
+            if job.on_status:
+                try:
+                    await job.on_status(job)
+                except Exception as e:
+                    print(f"SMS status callback failed: {e}")
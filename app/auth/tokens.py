@@ -1,43 +1,131 @@
 from datetime import datetime, timedelta
 from typing import Optional
+from uuid import uuid4
 
 import jwt
+from pymongo.errors import DuplicateKeyError
 
 from app.auth.exceptions import IncorrectToken
-from app.auth.models.auth import TokensRead, Tokens
+from app.auth.models.auth import TokensRead, Tokens, RevokedToken
 from app.auth.models.user import User
 from app.config import CONFIG
+from app.database import Watermark, find_one
 
 key = CONFIG.auth_secret_key
 
 
-async def validate_token(token: str, is_refresh=False) -> Optional[Tokens]:
+class RevocationList:
     """
-    Validates a token. Checks for the presence of a token in the database, lifetime
+    In-memory set of revoked token ids.
+    Local revocations apply immediately, revocations made by other workers are pulled by refresh()
+    """
+
+    def __init__(self):
+        self._revoked: dict[str, datetime] = {}
+        self._watermark = Watermark()
+
+    def __contains__(self, jti: str) -> bool:
+        return jti in self._revoked
+
+    def __len__(self):
+        return len(self._revoked)
+
+    async def revoke(self, claims: dict) -> None:
+        """
+        Revoke a token by its decoded claims
+
+        :param claims:
+        :return:
+        """
+        if not claims.get("jti"):
+            return
+
+        expire = datetime.utcfromtimestamp(claims["exp"])
+        self._revoked[claims["jti"]] = expire
+
+        try:
+            await RevokedToken(jti=claims["jti"], expire=expire).create()
+        except DuplicateKeyError:
+            pass
+
+    async def refresh(self) -> int:
+        """
+        Load revocations created since the last refresh and forget expired ones
+
+        :return: number of loaded revocations
+        """
+        now = datetime.utcnow()
+        self._revoked = {jti: expire for jti, expire in self._revoked.items() if expire > now}
+
+        query = RevokedToken.find(RevokedToken.expire > now)
+        since = self._watermark.since()
+        if since:
+            query = query.find(RevokedToken.id >= since)
+
+        loaded = 0
+        async for revoked in query:
+            self._revoked[revoked.jti] = revoked.expire
+            loaded += 1
+
+        self._watermark.advance(now)
+        return loaded
+
+
+revoked_tokens = RevocationList()
+
+
+def decode_token(token: str) -> Optional[dict]:
+    """
+    Checks the signature and the lifetime of a token without touching the database
 
     :param token:
-    :param is_refresh:
-    :return:
+    :return: token claims
     """
     try:
-        jwt.decode(token, key, algorithms=["HS256"])
-    except Exception:
-        pass
-        #return None
+        return jwt.decode(token, key, algorithms=["HS256"])
+    except jwt.PyJWTError:
+        return None
 
-    if is_refresh:
-        db_token = await Tokens.find_one(Tokens.refresh_token == token)
-    else:
-        db_token = await Tokens.find_one(Tokens.access_token == token)
 
-    if not db_token:
+async def validate_token(token: str, is_refresh=False) -> Optional[dict]:
+    """
+    Validates a token. Checks the signature, the lifetime and the revocation list in-process.
+    The database is only queried for tokens issued without an id or in strict mode
+
+    :param token:
+    :param is_refresh:
+    :return: token claims
+    """
+    claims = decode_token(token)
+    token_type = "refresh" if is_refresh else "access"
+
+    if not claims or claims.get("type", token_type) != token_type:
+        return None
+
+    if claims.get("jti") in revoked_tokens:
         return None
 
-    return db_token
+    if claims.get("jti") and not CONFIG.auth_strict_tokens:
+        return claims
+
+    if not await get_db_token(token, is_refresh):
+        return None
+
+    return claims
+
+
+async def get_db_token(token: str, is_refresh=False) -> Optional[Tokens]:
+    if is_refresh:
+        return await find_one("primary", Tokens, Tokens.refresh_token == token)
+
+    return await find_one("primary", Tokens, Tokens.access_token == token)
 
 
 async def authenticate(token: str) -> Optional[dict]:
-    db_token = await validate_token(token)
+    if not await validate_token(token):
+        return None
+
+    db_token = await get_db_token(token)
     if not db_token:
         return None
 
@@ -45,15 +133,32 @@ async def authenticate(token: str) -> Optional[dict]:
     return {"user": user, "auth": db_token}
 
 
+async def revoke_tokens(tokens: TokensRead) -> None:
+    """
+    Revokes both tokens of a pair
+
+    :param tokens:
+    :return:
+    """
+    for token in (tokens.access_token, tokens.refresh_token):
+        claims = decode_token(token)
+        if claims:
+            await revoked_tokens.revoke(claims)
+
+
 async def create_tokens(user: User) -> TokensRead:
     access_expire = datetime.utcnow() + timedelta(hours=48)
     refresh_expire = datetime.utcnow() + timedelta(days=30)
 
     return TokensRead(
         access_expire=access_expire,
-        access_token=jwt.encode({"phone": user.phone, "exp": access_expire}, key),
+        access_token=jwt.encode(
+            {"phone": user.phone, "exp": access_expire, "jti": uuid4().hex, "type": "access"}, key
+        ),
         refresh_expire=refresh_expire,
-        refresh_token=jwt.encode({"phone": user.phone, "exp": refresh_expire}, key)
+        refresh_token=jwt.encode(
+            {"phone": user.phone, "exp": refresh_expire, "jti": uuid4().hex, "type": "refresh"}, key
+        )
     )
 
 
@@ -61,10 +166,14 @@ async def renew_tokens(token: str) -> TokensRead:
     if not await validate_token(token, is_refresh=True):
         raise IncorrectToken
 
-    db_token = await Tokens.find_one(Tokens.refresh_token == token)
+    db_token = await get_db_token(token, is_refresh=True)
+
+    if not db_token:
+        raise IncorrectToken
 
     user = await User.get(db_token.user.ref.id)
     await db_token.delete()
+    await revoke_tokens(db_token)
 
     tokens = await create_tokens(user)
     await Tokens(
@@ -2,8 +2,9 @@ from typing import Optional, NamedTuple, Tuple, Dict, Any
 
 from app.auth.models.auth import Tokens, TokensRead
 from app.auth.models.user import User
-from app.auth.tokens import create_tokens
+from app.auth.tokens import create_tokens, revoke_tokens, validate_token
 from app.auth.utils.sms import verify_code
+from app.payments.promocode import promocode_allocator, promocodes
 
 
 class AuthData(NamedTuple):
@@ -20,13 +21,20 @@ async def authenticate(code: str) -> tuple[dict[str, User | TokensRead | Tokens
     new_user = False
     if not user:
         user = User(
-            phone=db_code.phone
+            phone=db_code.phone,
+            promocode=await promocode_allocator.allocate()
         )
         await user.create()
+        await promocodes.register(user)
         new_user = True
 
     tokens = await Tokens.find_one(Tokens.user.id == user.id)
 
+    if tokens and not await validate_token(tokens.access_token):
+        await tokens.delete()
+        await revoke_tokens(tokens)
+        tokens = None
+
     if tokens:
         tokens = TokensRead(**tokens.dict())
 
@@ -47,5 +55,10 @@ async def authenticate(code: str) -> tuple[dict[str, User | TokensRead | Tokens
 
 
 async def logout(user: User):
-    tokens = Tokens.find_one(Tokens.user.id == user.id)
+    tokens = await Tokens.find_one(Tokens.user.id == user.id)
+
+    if not tokens:
+        return
+
     await tokens.delete()
+    await revoke_tokens(tokens)
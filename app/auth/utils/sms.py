@@ -5,14 +5,17 @@ from typing import Optional
 from pydantic import ValidationError
 from pyotp import HOTP
 
-from app.auth.models.limits import Limit
 from app.auth.models.user import UserAuthCode, UserAuthCodeInfo
 from app.auth.sms_api import SMSApi
+from app.auth.sms_queue import SMSDispatcher, SMSJob, SMSQueueFull, StatusCallback
 from app.config import CONFIG
+from app.database import find_one
+from app.expiry import expiry
 from app.utils import create_counter
 
 hotp = HOTP(CONFIG.auth_secret_key)
 sms = SMSApi()
+dispatcher = SMSDispatcher(sms, workers=CONFIG.sms_workers, lane_size=CONFIG.sms_queue_size)
 counter = create_counter()
 
 
@@ -20,7 +23,15 @@ async def create_code() -> str:
     return hotp.at(counter() * randint(0, 1000))
 
 
-async def send_code(phone: str) -> Optional[UserAuthCodeInfo]:
+async def send_code(phone: str, on_status: Optional[StatusCallback] = None) -> Optional[UserAuthCodeInfo]:
+    """
+    Stores a new code and queues it for delivery. ``on_status`` is awaited with the SMS job
+    once it is sent or failed. A code that could not be delivered is removed, so it can be resent at once
+
+    :param phone:
+    :param on_status:
+    :return:
+    """
     old_code = await UserAuthCode.get_by_phone(phone)
 
     if old_code and old_code.can_send > datetime.utcnow():
@@ -31,13 +42,28 @@ async def send_code(phone: str) -> Optional[UserAuthCodeInfo]:
 
     code = await create_code()
 
-    await sms.send(phone, code)
+    code_info = await set_code(phone, code)
+    if not isinstance(code_info, UserAuthCodeInfo):
+        return code_info
+
+    async def report(job: SMSJob):
+        if job.status == "failed":
+            await UserAuthCode.find(UserAuthCode.phone == phone, UserAuthCode.code == code).delete()
+
+        if on_status:
+            await on_status(job)
+
+    try:
+        dispatcher.enqueue(phone, code, priority=1, on_status=report)
+    except SMSQueueFull:
+        await UserAuthCode.find(UserAuthCode.phone == phone, UserAuthCode.code == code).delete()
+        raise
 
-    return await set_code(phone, code)
+    return code_info
 
 
 async def get_code(code: str) -> UserAuthCode | None:
-    return await UserAuthCode.find_one(UserAuthCode.code == code)
+    return await find_one("primary", UserAuthCode, UserAuthCode.code == code)
 
 
 async def can_send_code(phone: str) -> bool:
@@ -60,6 +86,7 @@ async def set_code(phone: str, code: Optional[str] = None) -> UserAuthCodeInfo |
             can_send=datetime.utcnow() + timedelta(minutes=3)
         )
         await db_code.create()
+        expiry.schedule(UserAuthCode, db_code.expire)
     except ValidationError as e:
         return e
 
@@ -79,14 +106,3 @@ async def verify_code(code: str) -> UserAuthCode | None:
 
     return code
 
-
-async def check_codes() -> None:
-    async for i in UserAuthCode.find_all():
-        if i.expire <= datetime.utcnow():
-            await i.delete()
-
-
-async def check_limit() -> None:
-    async for i in Limit.find_all():
-        if i.expire >= datetime.utcnow():
-            await i.delete()
@@ -1,12 +1,69 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from typing import Optional, Union
+
+from beanie.odm.queries.find import FindMany
+from beanie.odm.utils.projection import get_projection
+
 from app.auth.models.user import User
-from app.chat.exceptions import MessageNotFound
-from app.chat.models import Message, ChatMessage
+from app.cluster import broker
+from app.chat.context import Turn, conversations
+from app.chat.exceptions import InvalidCursor, InvalidRange, MessageNotFound
+from app.chat.models import Message, ChatMessage, MessageTurn
+from app.config import CONFIG
+from app.database import count, read_collection
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
 from beanie import PydanticObjectId
 
 
-async def get_all_messages(user: User) -> list[ChatMessage]:
-    return await Message.find(Message.user.id == user.id).project(ChatMessage).to_list()
+# ChatMessage in its wire form, shaped by the server: no models are built for bulk reads
+WIRE_PROJECTION = {
+    "$project": {
+        "_id": 0,
+        "id": {"$toString": "$_id"},
+        "text": "$content",
+        "type": {"$cond": [{"$eq": ["$role", "user"]}, "user", "bot"]},
+        "date": {"$dateToString": {"date": {"$toDate": "$_id"}, "format": "%Y-%m-%dT%H:%M:%S+00:00"}}
+    }
+}
+
+Messages = Union[list[ChatMessage], list[dict]]
+
+
+async def read_messages(query: FindMany[Message], raw: bool = False) -> Messages:
+    """
+    Runs a message query with the "chat" read profile: history may be served by a secondary
+
+    :param query: filter, sort, skip and limit of the messages
+    :param raw: return wire-shaped dicts from an aggregation instead of ChatMessage models
+    :return:
+    """
+    collection = read_collection(Message, "chat")
+
+    if not raw:
+        cursor = collection.find(
+            query.get_filter_query(),
+            projection=get_projection(ChatMessage),
+            sort=query.sort_expressions or None,
+            skip=query.skip_number or 0,
+            limit=query.limit_number or 0
+        )
+        return [ChatMessage(**doc) async for doc in cursor]
+
+    pipeline = [{"$match": query.get_filter_query()}]
+    if query.sort_expressions:
+        pipeline.append({"$sort": dict(query.sort_expressions)})
+    if query.skip_number:
+        pipeline.append({"$skip": query.skip_number})
+    if query.limit_number:
+        pipeline.append({"$limit": query.limit_number})
+    pipeline.append(WIRE_PROJECTION)
+
+    return await collection.aggregate(pipeline).to_list(None)
+
+
+async def get_all_messages(user: User, raw: bool = False) -> Messages:
+    return await read_messages(Message.find(Message.user.id == user.id), raw)
 
 
 async def get_message(user: User, msg_id: PydanticObjectId) -> ChatMessage:
@@ -15,18 +72,167 @@ async def get_message(user: User, msg_id: PydanticObjectId) -> ChatMessage:
 
 
 async def get_messages_count(user: User) -> int:
-    return await Message.find(Message.user.id == user.id).count()
+    return await count("chat", Message, Message.user.id == user.id)
+
+
+async def get_messages_selection(user: User, start: int = None, end: int = None, raw: bool = False) -> Messages:
+    """
+    Offset selection of the user's history, messages from ``start`` up to ``end`` (exclusive)
 
+    :param user:
+    :param start: index of the first message, from the beginning when not set
+    :param end: index after the last message, to the end when not set
+    :param raw: see read_messages
+    :return:
+    """
+    for index in (start, end):
+        if index is not None and (not isinstance(index, int) or isinstance(index, bool) or index < 0):
+            raise InvalidRange
+
+    limit = None
+    if end is not None:
+        limit = end - (start or 0)
+        # A limit of 0 would read the rest of the history
+        if limit <= 0:
+            return []
+
+    return await read_messages(Message.find(Message.user.id == user.id, skip=start, limit=limit), raw)
+
+
+def encode_cursor(direction: str, msg_id: PydanticObjectId) -> str:
+    return urlsafe_b64encode(direction.encode() + msg_id.binary).decode()
 
-async def get_messages_selection(user: User, start: int = None, end: int = None) -> list[ChatMessage]:
-    return await Message.find(Message.user.id == user.id, skip=start, limit=end).project(ChatMessage).to_list()
 
+def decode_cursor(cursor: str) -> tuple[str, ObjectId]:
+    try:
+        raw = urlsafe_b64decode(cursor.encode())
+        direction, msg_id = raw[:1].decode(), ObjectId(raw[1:])
+    except (ValueError, TypeError, InvalidId):
+        raise InvalidCursor
+
+    if direction not in ("b", "a"):
+        raise InvalidCursor
+
+    return direction, msg_id
+
+
+def parse_message_id(msg_id: str) -> ObjectId:
+    try:
+        return ObjectId(msg_id)
+    except (InvalidId, TypeError):
+        raise InvalidCursor
+
+
+async def get_messages_page(user: User, before: str = None, after: str = None, cursor: str = None,
+                            limit: int = None, raw: bool = False) -> tuple[Messages, Optional[str]]:
+    """
+    A page of the user's history, in chronological order. Pages are range scans on _id,
+    so any page costs the same as the first one.
+
+    Without ``before``/``after`` the newest page is returned.
+
+    :param user:
+    :param before: return messages older than this message id
+    :param after: return messages newer than this message id
+    :param cursor: opaque cursor returned with the previous page, takes precedence over before/after
+    :param limit: page size
+    :param raw: see read_messages
+    :return: messages and the cursor of the next page in the same direction, None on the last page
+    """
+    if not isinstance(limit, int) or limit <= 0:
+        limit = CONFIG.chat_page_size
+    limit = min(limit, CONFIG.chat_max_page_size)
+
+    if cursor:
+        direction, msg_id = decode_cursor(cursor)
+    elif after:
+        direction, msg_id = "a", parse_message_id(after)
+    elif before:
+        direction, msg_id = "b", parse_message_id(before)
+    else:
+        direction, msg_id = "b", None
+
+    query = Message.find(Message.user.id == user.id)
+    if direction == "a":
+        query = query.find(Message.id > msg_id).sort(+Message.id)
+    else:
+        if msg_id:
+            query = query.find(Message.id < msg_id)
+        query = query.sort(-Message.id)
+
+    messages = await read_messages(query.limit(limit), raw)
+
+    next_cursor = None
+    if len(messages) == limit:
+        last_id = messages[-1]["id"] if raw else messages[-1].id
+        next_cursor = encode_cursor(direction, ObjectId(last_id))
+
+    if direction == "b":
+        messages.reverse()
+
+    return messages, next_cursor
+
+
+async def get_last_turns(user: User) -> list[Turn]:
+    """
+    The tail of the user's conversation since the last context reset,
+    from the context cache or one projected query
+
+    :param user:
+    :return: turns in chronological order
+    """
+    turns = conversations.get(user.id)
+
+    if turns is None:
+        messages = await Message.find(Message.user.id == user.id) \
+            .sort(-Message.id) \
+            .limit(conversations.max_turns) \
+            .project(MessageTurn) \
+            .to_list()
+
+        turns = []
+        for msg in messages:
+            turns.append(Turn(msg.id, msg.role, msg.content, msg.reset))
+            if msg.reset:
+                break
+        turns.reverse()
 
-async def add_message(user: User, message: str, role: str = "user") -> PydanticObjectId:
-    msg = Message(role=role, content=message, user=user)
+        conversations.put(user.id, turns)
+
+    return turns
+
+
+async def add_message(user: User, message: str, role: str = "user",
+                      msg_id: PydanticObjectId = None, reset: bool = False) -> ChatMessage:
+    msg = Message(id=msg_id, role=role, content=message, user=user, reset=reset)
     await msg.create()
+    conversations.append(user.id, Turn(msg.id, msg.role, msg.content, msg.reset))
+    await broker.publish("conversation", str(user.id))
 
-    return msg.id
+    return ChatMessage.from_message(msg)
+
+
+async def add_messages(user: User, messages: list[dict]) -> list[ChatMessage]:
+    """
+    Stores several messages in one round trip
+
+    :param user:
+    :param messages: keyword arguments of add_message (message, role, reset), in chronological order
+    :return:
+    """
+    # Ids are generated here, in order, so the messages keep their order and need no read back
+    docs = [
+        Message(id=PydanticObjectId(), role=msg.get("role", "user"), content=msg["message"], user=user,
+                reset=msg.get("reset", False))
+        for msg in messages
+    ]
+    await Message.insert_many(docs)
+
+    for msg in docs:
+        conversations.append(user.id, Turn(msg.id, msg.role, msg.content, msg.reset))
+    await broker.publish("conversation", str(user.id))
+
+    return [ChatMessage.from_message(msg) for msg in docs]
 
 
 async def delete_message(user: User, msg_id: str) -> PydanticObjectId:
@@ -36,5 +242,7 @@ async def delete_message(user: User, msg_id: str) -> PydanticObjectId:
         raise MessageNotFound
 
     await msg.delete()
+    conversations.remove(user.id, msg.id)
+    await broker.publish("conversation", str(user.id))
 
     return msg.id
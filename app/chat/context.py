@@ -0,0 +1,83 @@
+from collections import OrderedDict, deque
+from typing import NamedTuple, Optional
+
+from beanie import PydanticObjectId
+
+from app.config import CONFIG
+from app.metrics import metrics
+
+
+class Turn(NamedTuple):
+    id: PydanticObjectId
+    role: str
+    content: str
+    reset: bool = False
+
+
+class ConversationCache:
+    """
+    Size-bounded LRU of the last turns of every user's conversation.
+
+    An entry is the exact tail of the user's history since the last context reset: it is loaded
+    from the database once and then kept up to date by chat.add_message and chat.delete_message.
+    Users without an entry fall back to the database.
+    """
+
+    def __init__(self, users: int = 10000, turns: int = 20):
+        self.max_users = users
+        self.max_turns = turns
+        self._users: OrderedDict[PydanticObjectId, deque[Turn]] = OrderedDict()
+
+    def get(self, user_id: PydanticObjectId) -> Optional[list[Turn]]:
+        turns = self._users.get(user_id)
+
+        if turns is None:
+            metrics.counter("chat.context_cache.misses").inc()
+            return None
+
+        metrics.counter("chat.context_cache.hits").inc()
+        self._users.move_to_end(user_id)
+        return list(turns)
+
+    def put(self, user_id: PydanticObjectId, turns: list[Turn]) -> None:
+        """
+        Store the tail of a history loaded from the database
+
+        :param user_id:
+        :param turns: turns in chronological order
+        :return:
+        """
+        self._users[user_id] = deque(turns, maxlen=self.max_turns)
+        self._users.move_to_end(user_id)
+
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    def append(self, user_id: PydanticObjectId, turn: Turn) -> None:
+        turns = self._users.get(user_id)
+        if turns is None:
+            return
+
+        if turn.reset:
+            turns.clear()
+        turns.append(turn)
+
+    def remove(self, user_id: PydanticObjectId, msg_id: PydanticObjectId) -> None:
+        turns = self._users.get(user_id)
+        removed = next((turn for turn in turns or () if turn.id == msg_id), None)
+        if not removed:
+            return
+
+        # A full tail loses its oldest turn for good and a removed reset uncovers older turns,
+        # load it again on the next use
+        if len(turns) == turns.maxlen or removed.reset:
+            del self._users[user_id]
+            return
+
+        self._users[user_id] = deque((turn for turn in turns if turn.id != msg_id), maxlen=self.max_turns)
+
+    def invalidate(self, user_id: PydanticObjectId) -> None:
+        self._users.pop(user_id, None)
+
+
+conversations = ConversationCache(users=CONFIG.gpt_context_users, turns=CONFIG.gpt_context_turns)
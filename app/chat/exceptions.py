@@ -1,2 +1,10 @@
 class MessageNotFound(Exception):
     """Message not found in database"""
+
+
+class InvalidCursor(Exception):
+    """Malformed message id or history cursor"""
+
+
+class InvalidRange(Exception):
+    """Malformed start/end of a history selection"""
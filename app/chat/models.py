@@ -1,5 +1,6 @@
-from beanie import Document, Link
-from pydantic import BaseModel, validator
+import pymongo
+from beanie import Document, Link, PydanticObjectId
+from pydantic import BaseModel, Field, validator
 from datetime import datetime
 
 from app.auth.models.user import User
@@ -12,12 +13,27 @@ class MessageRead(BaseModel):
 
 class Message(Document, MessageRead):
     user: Link[User]
+    # The conversation context starts over from this message
+    reset: bool = False
+
+    class Settings:
+        indexes = [
+            # History pages, counts, single-message lookups and the context tail of a user
+            pymongo.IndexModel([("user.$id", pymongo.ASCENDING), ("_id", pymongo.DESCENDING)])
+        ]
 
     @property
     def created(self):
         return self.id.generation_time
 
 
+class MessageTurn(BaseModel):
+    id: PydanticObjectId = Field(alias="_id")
+    role: str
+    content: str
+    reset: bool = False
+
+
 class ChatMessage(BaseModel):
     id: str
     text: str
@@ -40,6 +56,16 @@ class ChatMessage(BaseModel):
         return t
 
 
+    @classmethod
+    def from_message(cls, msg: Message) -> "ChatMessage":
+        """
+        Builds the wire form of a stored message without reading it back
+
+        :param msg:
+        :return:
+        """
+        return cls(id=str(msg.id), text=msg.content, type=msg.role, date=msg.created)
+
     def __init__(self, **data):
         if data.get("_id"):
             if not data.get("date"):
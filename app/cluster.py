@@ -0,0 +1,213 @@
+import asyncio
+import inspect
+import json
+import uuid
+from typing import Any, Awaitable, Callable, Optional, Union
+
+import socketio
+from redis import asyncio as aioredis
+
+from app.config import CONFIG
+from app.metrics import metrics
+
+Handler = Callable[[Any], Union[Awaitable[None], None]]
+
+
+def create_client_manager() -> socketio.AsyncManager:
+    """
+    Socket.IO client manager of the configured backend. With Redis, emits to rooms reach
+    the sockets connected to every worker
+
+    :return:
+    """
+    if CONFIG.cluster_backend == "redis":
+        return socketio.AsyncRedisManager(CONFIG.redis_url, channel=f"{CONFIG.cluster_channel}:socketio")
+
+    return socketio.AsyncManager()
+
+
+def install_client_manager(server: socketio.AsyncServer, manager: socketio.AsyncManager) -> None:
+    """
+    FastAPISIO creates its AsyncServer itself and does not accept a client manager,
+    replace it before the first client connects
+
+    :param server:
+    :param manager:
+    :return:
+    """
+    server.manager = manager
+    manager.set_server(server)
+    server.manager_initialized = False
+
+
+class SessionStore:
+    """
+    Socket sessions kept in the engine.io session of the worker holding the connection
+    """
+
+    def __init__(self, server: socketio.AsyncServer):
+        self.server = server
+
+    async def get(self, sid: str) -> dict:
+        return await self.server.get_session(sid)
+
+    async def save(self, sid: str, session: dict) -> None:
+        await self.server.save_session(sid, session)
+
+    async def delete(self, sid: str) -> None:
+        # Dropped by engine.io together with the connection
+        pass
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Socket sessions in Redis, readable from every worker. Sessions are JSON documents
+    which expire ``ttl`` seconds after the last save
+    """
+
+    def __init__(self, redis: aioredis.Redis, prefix: str, ttl: int):
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, sid: str) -> str:
+        return f"{self.prefix}:session:{sid}"
+
+    async def get(self, sid: str) -> dict:
+        raw = await self.redis.get(self._key(sid))
+        return json.loads(raw) if raw else {}
+
+    async def save(self, sid: str, session: dict) -> None:
+        await self.redis.set(self._key(sid), json.dumps(session), ex=self.ttl)
+
+    async def delete(self, sid: str) -> None:
+        await self.redis.delete(self._key(sid))
+
+
+class Broker:
+    """
+    Delivers cache invalidations to the other workers.
+
+    Publishers update their own caches themselves and publish the change, subscribers of the
+    other workers drop their copies. A single worker has nobody to notify, so the in-memory
+    broker only keeps the subscriptions.
+    """
+
+    def __init__(self):
+        self._handlers: dict[str, list[Handler]] = {}
+
+    def subscribe(self, channel: str, handler: Handler) -> None:
+        """
+        Call ``handler`` with the data of every message another worker publishes to ``channel``
+
+        :param channel:
+        :param handler: sync or async callable
+        :return:
+        """
+        self._handlers.setdefault(channel, []).append(handler)
+
+    async def publish(self, channel: str, data: Any) -> None:
+        """
+        :param channel:
+        :param data: JSON-serializable message
+        :return:
+        """
+        pass
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def _dispatch(self, channel: str, data: Any) -> None:
+        metrics.counter(f"cluster.{channel}.received").inc()
+
+        for handler in self._handlers.get(channel, ()):
+            try:
+                result = handler(data)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                print(f"Cluster handler of {channel} failed: {e}")
+
+
+class RedisBroker(Broker):
+    """
+    Broker over one Redis pub/sub channel. Messages published while a worker is disconnected
+    from Redis are lost to it, the caches are bounded by their own limits meanwhile
+    """
+
+    retry_delay = 1
+
+    def __init__(self, redis: aioredis.Redis, channel: str):
+        super().__init__()
+        self.redis = redis
+        self.channel = channel
+        # Every worker receives its own messages too, they are skipped by origin
+        self.origin = uuid.uuid4().hex
+
+        self._task: Optional[asyncio.Task] = None
+
+    async def publish(self, channel: str, data: Any) -> None:
+        message = json.dumps({"origin": self.origin, "channel": channel, "data": data})
+
+        try:
+            await self.redis.publish(self.channel, message)
+            metrics.counter(f"cluster.{channel}.published").inc()
+        except aioredis.RedisError as e:
+            metrics.counter("cluster.publish_errors").inc()
+            print(f"Cluster publish to {channel} failed: {e}")
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _listen(self) -> None:
+        while True:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+
+            try:
+                await pubsub.subscribe(self.channel)
+
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+
+                    # A bad message is dropped, only Redis errors resubscribe
+                    try:
+                        message = json.loads(message["data"])
+                        if message["origin"] != self.origin:
+                            await self._dispatch(message["channel"], message["data"])
+                    except Exception as e:
+                        metrics.counter("cluster.message_errors").inc()
+                        print(f"Cluster message dropped: {e}")
+            except aioredis.RedisError as e:
+                metrics.counter("cluster.listen_errors").inc()
+                print(f"Cluster subscription failed: {e}")
+                await asyncio.sleep(self.retry_delay)
+            finally:
+                await pubsub.close()
+
+
+def create_session_store(server: socketio.AsyncServer) -> SessionStore:
+    if CONFIG.cluster_backend == "redis":
+        return RedisSessionStore(redis, CONFIG.cluster_channel, CONFIG.cluster_session_ttl)
+
+    return SessionStore(server)
+
+
+def create_broker() -> Broker:
+    if CONFIG.cluster_backend == "redis":
+        return RedisBroker(redis, f"{CONFIG.cluster_channel}:broker")
+
+    return Broker()
+
+
+# Connections are opened on first use
+redis = aioredis.from_url(CONFIG.redis_url) if CONFIG.cluster_backend == "redis" else None
+broker = create_broker()
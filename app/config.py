@@ -7,19 +7,109 @@ class Settings(BaseSettings):
     sms_api_key: str = config("SMS_API_KEY")
     auth_secret_key: str = config("SECRET_KEY")
     auth_salt: str = config("SALT")
+    # Look up every token in the database instead of the in-memory revocation list
+    auth_strict_tokens: bool = config("AUTH_STRICT_TOKENS", default=False, cast=bool)
+    auth_revocation_refresh: int = config("AUTH_REVOCATION_REFRESH", default=5, cast=int)
+
+    # SMS
+    sms_server: str = config("SMS_SERVER", default="http://api.sms-prosto.ru")
+    sms_connect_timeout: float = config("SMS_CONNECT_TIMEOUT", default=3, cast=float)
+    sms_read_timeout: float = config("SMS_READ_TIMEOUT", default=10, cast=float)
+    sms_pool_size: int = config("SMS_POOL_SIZE", default=20, cast=int)
+    sms_max_concurrency: int = config("SMS_MAX_CONCURRENCY", default=50, cast=int)
+    sms_retries: int = config("SMS_RETRIES", default=3, cast=int)
+    sms_backoff: float = config("SMS_BACKOFF", default=0.2, cast=float)
+    sms_workers: int = config("SMS_WORKERS", default=4, cast=int)
+    sms_queue_size: int = config("SMS_QUEUE_SIZE", default=1000, cast=int)
 
     # ChatGPT
     gpt_api_key: str = config("CHATGPT_API_KEY")
     gpt_model: str = config("CHATGPT_MODEL")
+    gpt_api_base: str = config("CHATGPT_API_BASE", default="https://api.openai.com/v1")
+    # Stream answers as add_message_chunk events unless the client asks otherwise
+    gpt_stream: bool = config("CHATGPT_STREAM", default=False, cast=bool)
+    # Conversation tails kept in memory: users and turns per user
+    gpt_context_users: int = config("CHATGPT_CONTEXT_USERS", default=10000, cast=int)
+    gpt_context_turns: int = config("CHATGPT_CONTEXT_TURNS", default=20, cast=int)
+    # Estimated prompt size the history is packed into, including the system prompt and the question
+    gpt_context_tokens: int = config("CHATGPT_CONTEXT_TOKENS", default=2000, cast=int)
+    # Requests in flight to the API, across all users
+    gpt_concurrency: int = config("CHATGPT_CONCURRENCY", default=16, cast=int)
+    # Requests per minute of a user by tariff, "default" (required) applies to the tariffs not listed, 0 - no requests
+    gpt_rate_limits: str = config("CHATGPT_RATE_LIMITS", default="free=6,default=30")
+    gpt_rate_burst: int = config("CHATGPT_RATE_BURST", default=3, cast=int)
+    # Longer rate limit delays are answered with 429 right away
+    gpt_max_wait: float = config("CHATGPT_MAX_WAIT", default=30, cast=float)
+    # Pause after a 429 of the API without Retry-After
+    gpt_upstream_pause: float = config("CHATGPT_UPSTREAM_PAUSE", default=5, cast=float)
+    # Reuse answers to the same question in the same context
+    gpt_cache: bool = config("CHATGPT_CACHE", default=False, cast=bool)
+    gpt_cache_size: int = config("CHATGPT_CACHE_SIZE", default=10000, cast=int)
+    gpt_cache_ttl: float = config("CHATGPT_CACHE_TTL", default=3600, cast=float)
+
+    # LLM backend
+    # openai - the ChatGPT API; stub - local answers with model-like latency for load tests, no network
+    llm_backend: str = config("LLM_BACKEND", default="openai")
+    # Stub latencies in ms and answer sizes in words: "fixed:v", "uniform:low:high" or "lognormal:median:sigma"
+    llm_stub_first_token: str = config("LLM_STUB_FIRST_TOKEN", default="lognormal:400:0.5")
+    llm_stub_token_delay: str = config("LLM_STUB_TOKEN_DELAY", default="fixed:20")
+    llm_stub_words: str = config("LLM_STUB_WORDS", default="uniform:20:120")
+    llm_stub_seed: int = config("LLM_STUB_SEED", default=0, cast=int)
+
+    # Chat
+    chat_page_size: int = config("CHAT_PAGE_SIZE", default=50, cast=int)
+    chat_max_page_size: int = config("CHAT_MAX_PAGE_SIZE", default=200, cast=int)
+    # Send message pairs (question and answer, welcome) as one add_messages event instead of two add_message
+    chat_batch_emits: bool = config("CHAT_BATCH_EMITS", default=False, cast=bool)
+
+    # Cluster
+    # memory - a single worker; redis - workers share Socket.IO rooms, sessions and cache invalidations
+    cluster_backend: str = config("CLUSTER_BACKEND", default="memory")
+    redis_url: str = config("REDIS_URL", default="redis://localhost:6379/0")
+    # Prefix of the Redis channels and keys, shared by all workers of a deployment
+    cluster_channel: str = config("CLUSTER_CHANNEL", default="nika")
+    cluster_session_ttl: int = config("CLUSTER_SESSION_TTL", default=86400, cast=int)
 
     # Database
     db_host: str = config("DB_HOST")
     db_port: int = config("DB_PORT")
     db_user: str = config("DB_USER")
     db_pass: str = config("DB_PASS")
+    db_auth_source: str = config("DB_AUTH_SOURCE", default="admin")
+    db_name: str = config("DB_NAME", default="db_name")
+    # Connection pool of the shared client, the minimum is opened at startup
+    db_max_pool_size: int = config("DB_MAX_POOL_SIZE", default=100, cast=int)
+    db_min_pool_size: int = config("DB_MIN_POOL_SIZE", default=10, cast=int)
+    db_max_idle_time: int = config("DB_MAX_IDLE_TIME", default=300, cast=int)
+    # Seconds to wait for a free connection before failing the operation
+    db_wait_queue_timeout: int = config("DB_WAIT_QUEUE_TIMEOUT", default=10, cast=int)
+    db_connect_timeout: int = config("DB_CONNECT_TIMEOUT", default=5, cast=int)
+    db_server_selection_timeout: int = config("DB_SERVER_SELECTION_TIMEOUT", default=10, cast=int)
+    # 0 - no socket timeout
+    db_socket_timeout: int = config("DB_SOCKET_TIMEOUT", default=30, cast=int)
+    # Wire compression, e.g. "zstd,snappy,zlib" (zstd and snappy need their python packages)
+    db_compressors: str = config("DB_COMPRESSORS", default="")
+    db_read_preference: str = config("DB_READ_PREFERENCE", default="primary")
+    # Read profiles (app.database.READ_PROFILES), auth reads always go to the primary.
+    # Secondaries (e.g. secondaryPreferred) may miss writes made just before the read
+    db_read_chat: str = config("DB_READ_CHAT", default="primary")
+    db_read_catalog: str = config("DB_READ_CATALOG", default="primary")
+    # Secondaries lagging behind more are skipped by the profiles, at least 90; -1 - no bound
+    db_max_staleness: int = config("DB_MAX_STALENESS", default=90, cast=int)
 
     # Payments
     tinkoff_password: str = config("TINKOFF_PASSWORD")
+    # Reload period of the tariff catalog when the database has no change streams (standalone server)
+    tariff_poll_interval: int = config("TARIFF_POLL_INTERVAL", default=60, cast=int)
+    # Promocode lookups: owners and misses are cached for the TTL, unknown codes are rejected by a bloom filter
+    promocode_cache_size: int = config("PROMOCODE_CACHE_SIZE", default=10000, cast=int)
+    promocode_cache_ttl: float = config("PROMOCODE_CACHE_TTL", default=30, cast=float)
+    promocode_bloom_error: float = config("PROMOCODE_BLOOM_ERROR", default=0.01, cast=float)
+    # Pull of the codes created on other workers, in case an announcement was lost
+    promocode_refresh: int = config("PROMOCODE_REFRESH", default=60, cast=int)
+    # Codes reserved for new users per round trip, the next batch is reserved when the pool falls to the low water
+    promocode_batch: int = config("PROMOCODE_BATCH", default=200, cast=int)
+    promocode_low_water: int = config("PROMOCODE_LOW_WATER", default=50, cast=int)
 
     # App Info
     app_version: str = "1.0.0"
@@ -1,12 +1,223 @@
-from beanie import init_beanie
-from motor.motor_asyncio import AsyncIOMotorClient
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional, Type, TypeVar
+from urllib.parse import quote_plus
+
+from beanie import Document, init_beanie
+from beanie.odm.utils.parsing import parse_obj
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from pymongo import monitoring
+from pymongo.read_preferences import Primary, make_read_preference, read_pref_mode_from_name
 
 from app.config import CONFIG
+from app.metrics import metrics
 
-DATABASE_URI_WITH_AUTH = f"mongodb://{CONFIG.db_user}:{CONFIG.db_pass}@{CONFIG.db_host}:{CONFIG.db_port}"
+DATABASE_URI_WITH_AUTH = f"mongodb://{quote_plus(CONFIG.db_user)}:{quote_plus(CONFIG.db_pass)}" \
+                         f"@{CONFIG.db_host}:{CONFIG.db_port}/?authSource={CONFIG.db_auth_source}"
 DATABASE_URI = f"mongodb://{CONFIG.db_host}:{CONFIG.db_port}"
 
+DocumentType = TypeVar("DocumentType", bound=Document)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Connection pool saturation as metrics: open and checked out connections, operations waiting
+    for a connection and the time they wait.
+
+    Motor runs pymongo in worker threads, a checkout starts and ends on the same thread,
+    so the wait is timed in a thread local
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _gauge(self, name: str, amount: int) -> None:
+        with self._lock:
+            metrics.gauge(name).inc(amount)
+
+    def _waited(self) -> None:
+        started = getattr(self._local, "started", None)
+        self._local.started = None
+
+        if started is not None:
+            self._gauge("db.pool.waiting", -1)
+            metrics.summary("db.pool.wait_seconds").observe(time.perf_counter() - started)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        metrics.counter("db.pool.cleared").inc()
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._gauge("db.pool.connections", 1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._gauge("db.pool.connections", -1)
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+        self._gauge("db.pool.waiting", 1)
+
+    def connection_check_out_failed(self, event):
+        self._waited()
+        metrics.counter(f"db.pool.checkout_failed.{event.reason}").inc()
+
+    def connection_checked_out(self, event):
+        self._waited()
+        self._gauge("db.pool.checked_out", 1)
+
+    def connection_checked_in(self, event):
+        self._gauge("db.pool.checked_out", -1)
+
+
+pool_metrics = PoolMetrics()
+client: Optional[AsyncIOMotorClient] = None
+
+
+def create_client() -> AsyncIOMotorClient:
+    options = dict(
+        maxPoolSize=CONFIG.db_max_pool_size,
+        minPoolSize=CONFIG.db_min_pool_size,
+        maxIdleTimeMS=CONFIG.db_max_idle_time * 1000,
+        waitQueueTimeoutMS=CONFIG.db_wait_queue_timeout * 1000,
+        connectTimeoutMS=CONFIG.db_connect_timeout * 1000,
+        serverSelectionTimeoutMS=CONFIG.db_server_selection_timeout * 1000,
+        socketTimeoutMS=CONFIG.db_socket_timeout * 1000 or None,
+        readPreference=CONFIG.db_read_preference,
+        event_listeners=[pool_metrics]
+    )
+    if CONFIG.db_compressors:
+        options["compressors"] = CONFIG.db_compressors
+
+    return AsyncIOMotorClient(DATABASE_URI_WITH_AUTH if CONFIG.db_user else DATABASE_URI, **options)
+
+
+def get_client() -> AsyncIOMotorClient:
+    """
+    The process-wide client, every collection shares its connection pool
+
+    :return:
+    """
+    global client
+    if client is None:
+        client = create_client()
+    return client
+
+
+def read_preference(mode: str, max_staleness: int = -1):
+    """
+    :param mode: primary, primaryPreferred, secondary, secondaryPreferred or nearest
+    :param max_staleness: seconds a secondary may lag behind to be read from, -1 - no bound
+    :return:
+    """
+    mode = read_pref_mode_from_name(mode)
+    # The primary is never stale, pymongo refuses a bound for it
+    return make_read_preference(mode, None, max_staleness if mode else -1)
+
+
+# Read profiles: where the reads of a module may go. Queries without a profile follow DB_READ_PREFERENCE
+READ_PROFILES = {
+    # Auth flows read what they have just written
+    "primary": Primary(),
+    # History pages and counts
+    "chat": read_preference(CONFIG.db_read_chat, CONFIG.db_max_staleness),
+    # Tariffs and promocodes
+    "catalog": read_preference(CONFIG.db_read_catalog, CONFIG.db_max_staleness),
+}
+
+
+def read_collection(model: Type[Document], profile: str) -> AsyncIOMotorCollection:
+    """
+    The model's collection reading with the preference of ``profile``. Beanie queries have no
+    per-query read preference, routed reads run on this collection with the filter of a beanie query
+
+    :param model:
+    :param profile: READ_PROFILES key
+    :return:
+    """
+    return model.get_motor_collection().with_options(read_preference=READ_PROFILES[profile])
+
+
+async def find_one(profile: str, model: Type[DocumentType], *conditions) -> Optional[DocumentType]:
+    doc = await read_collection(model, profile).find_one(model.find(*conditions).get_filter_query())
+    return parse_obj(model, doc) if doc is not None else None
+
+
+async def count(profile: str, model: Type[Document], *conditions) -> int:
+    return await read_collection(model, profile).count_documents(model.find(*conditions).get_filter_query())
+
+
+class Watermark:
+    """
+    Position of incremental loads of a collection: the documents created since the last load
+    are selected by the creation time in their ObjectId
+    """
+
+    # Overlap between loads. ObjectIds of different processes are only ordered to the second
+    overlap = timedelta(seconds=5)
+
+    def __init__(self):
+        self.last_seen: Optional[datetime] = None
+
+    def since(self) -> Optional[ObjectId]:
+        """
+        :return: lowest _id of the next load, None before the first one
+        """
+        if self.last_seen is None:
+            return None
+
+        return ObjectId.from_datetime(self.last_seen - self.overlap)
+
+    def advance(self, started: datetime) -> None:
+        """
+        Record a load
+
+        :param started: time the load started at, in UTC
+        :return:
+        """
+        self.last_seen = started
+
+
+async def warm_up(connections: int) -> None:
+    """
+    Checks that the database answers and opens ``connections`` pool connections before the first request.
+    Raises ServerSelectionTimeoutError when the database is unreachable, so a broken worker fails at startup
+
+    :param connections:
+    :return:
+    """
+    started = time.perf_counter()
+    admin = get_client().admin
+
+    await admin.command("ping")
+    # Concurrent pings hold separate connections, the pool grows to their number
+    await asyncio.gather(*(admin.command("ping") for _ in range(connections - 1)))
+
+    print(f"Database is up, {metrics.gauge('db.pool.connections').value} connections "
+          f"in {(time.perf_counter() - started) * 1000:.0f} ms")
+
 
 async def init_db(models: list):
-    client = AsyncIOMotorClient(DATABASE_URI)
-    await init_beanie(database=client.db_name, document_models=models)
+    await warm_up(max(1, CONFIG.db_min_pool_size))
+    await init_beanie(database=get_client()[CONFIG.db_name], document_models=models)
+
+
+def close_db() -> None:
+    global client
+    if client is not None:
+        client.close()
+        client = None
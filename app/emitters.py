@@ -0,0 +1,27 @@
+from typing import Optional
+
+from fastapi_sio import FastAPISIO
+
+from app.schemas import WSResponse, encode_response
+
+
+class Emitter:
+    """
+    Server-sent Socket.IO event with a WSResponse payload.
+
+    Created once at import: the event is registered with FastAPISIO for the AsyncAPI docs
+    a single time and payloads go through the precompiled serializers of app.schemas.
+    """
+
+    def __init__(self, sio: FastAPISIO, event: str, description: Optional[str] = None):
+        self.event = event
+        self._server = sio._sio
+        sio.create_emitter(event, model=WSResponse, description=description)
+
+    async def emit(self, response: WSResponse, **kwargs) -> None:
+        """
+        :param response:
+        :param kwargs: AsyncServer.emit arguments (to, room, skip_sid)
+        :return:
+        """
+        await self._server.emit(self.event, data=encode_response(response), **kwargs)
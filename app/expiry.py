@@ -0,0 +1,138 @@
+import asyncio
+import heapq
+from datetime import datetime, timedelta
+from typing import Optional, Type
+
+import pymongo
+from beanie import Document
+
+from app.metrics import metrics
+
+
+class ExpiryScheduler:
+    """
+    Deletes expired documents in bulk at their deadlines.
+
+    Keeps the earliest pending deadline of every watched collection in a min-heap and sleeps
+    until the first one. Deadlines come from documents created in this process (schedule())
+    and from the database after every sweep, so documents created by other workers are covered too.
+    The TTL indexes on the same fields remain as a backstop.
+    """
+
+    retry_delay = timedelta(seconds=5)
+
+    def __init__(self):
+        self._documents: dict[str, tuple[Type[Document], str]] = {}
+        self._scheduled: dict[str, datetime] = {}
+        self._heap: list[tuple[datetime, str]] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def watch(self, document: Type[Document], field: str = "expire") -> None:
+        """
+        Register a collection whose documents expire at ``field``
+
+        :param document:
+        :param field:
+        :return:
+        """
+        self._documents[document.__name__] = (document, field)
+
+    def schedule(self, document: Type[Document], expire: datetime) -> None:
+        """
+        Make sure the collection is swept no later than ``expire``
+
+        :param document:
+        :param expire:
+        :return:
+        """
+        name = document.__name__
+        scheduled = self._scheduled.get(name)
+
+        if scheduled and scheduled <= expire:
+            return
+
+        self._scheduled[name] = expire
+        heapq.heappush(self._heap, (expire, name))
+
+        if self._heap[0] == (expire, name):
+            self._wakeup.set()
+
+    async def start(self) -> None:
+        for name in self._documents:
+            await self._schedule_next(name)
+
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def sweep(self, name: str) -> int:
+        """
+        Delete every expired document of a collection
+
+        :param name: document class name
+        :return: number of deleted documents
+        """
+        document, field = self._documents[name]
+
+        started = datetime.utcnow()
+        result = await document.get_motor_collection().delete_many({field: {"$lte": started}})
+
+        metrics.counter(f"expiry.{name}.sweeps").inc()
+        metrics.counter(f"expiry.{name}.deleted").inc(result.deleted_count)
+        metrics.summary(f"expiry.{name}.deleted_per_sweep").observe(result.deleted_count)
+        metrics.summary(f"expiry.{name}.sweep_seconds").observe((datetime.utcnow() - started).total_seconds())
+
+        return result.deleted_count
+
+    async def _schedule_next(self, name: str) -> None:
+        document, field = self._documents[name]
+
+        next_doc = await document.get_motor_collection().find_one(
+            {field: {"$ne": None}},
+            projection={field: True},
+            sort=[(field, pymongo.ASCENDING)]
+        )
+
+        if next_doc:
+            self.schedule(document, next_doc[field])
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            deadline, name = self._heap[0]
+            delay = (deadline - datetime.utcnow()).total_seconds()
+
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+
+            # A stale entry, an earlier deadline was scheduled for the collection
+            if self._scheduled.get(name) != deadline:
+                continue
+
+            del self._scheduled[name]
+
+            try:
+                await self.sweep(name)
+                await self._schedule_next(name)
+            except Exception as e:
+                metrics.counter(f"expiry.{name}.errors").inc()
+                print(f"Expiry sweep of {name} failed: {e}")
+                self.schedule(self._documents[name][0], datetime.utcnow() + self.retry_delay)
+
+
+expiry = ExpiryScheduler()
@@ -1,8 +1,10 @@
-import asyncio
-import nest_asyncio
+import functools
+import inspect
+from typing import Optional
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
+from beanie import PydanticObjectId
 from fastapi import FastAPI
 from fastapi.encoders import jsonable_encoder
 from fastapi_sio import FastAPISIO
@@ -10,35 +12,108 @@ from fastapi_sio import FastAPISIO
 import app.auth.tokens as token_auth
 import app.auth.user as user_auth
 import app.auth.utils.sms as sms
+import app.cluster as cluster
 import app.database as db
 import app.chat.chat as chat
 import app.utils as utils
 import app.payments.promocode as promo
 import app.payments.tinkoff as tinkoff
 
+from app.ai.backends import RateLimitError
 from app.ai.chatgpt import gpt
-from app.payments.models import Tariff, Order, OrderRead
-from app.auth.models.auth import Tokens
+from app.ai.chatgpt.scheduler import RateLimited, gpt_scheduler
+from app.payments.catalog import tariff_catalog
+from app.payments.models import Tariff, TariffRead, Order, OrderRead, PromocodeReservation
+from app.auth.context import UserContext
+from app.auth.models.auth import Tokens, TokensRead, RevokedToken
 from app.auth.models.limits import Limit
 from app.auth.models.user import *
 from app.auth.sms_api import SMSBaseException
+from app.auth.sms_queue import SMSJob
 from app.chat.models import Message, ChatMessage
 from app.config import CONFIG
-from app.schemas import WSResponse
+from app.emitters import Emitter
+from app.expiry import expiry
+from app.metrics import metrics
+from app.schemas import WSResponse, encode_response, register_serializer
 
 app = FastAPI(docs_url=None, redoc_url=None)
 sio = FastAPISIO(app=app, mount_location='/')
+cluster.install_client_manager(sio._sio, cluster.create_client_manager())
+sessions = cluster.create_session_store(sio._sio)
+
+connect_emitter = Emitter(sio, "auth")
+add_message_emitter = Emitter(sio, "add_message")
+add_messages_emitter = Emitter(sio, "add_messages", description="Several new messages in one packet")
+add_message_chunk_emitter = Emitter(sio, "add_message_chunk")
+delete_message_emitter = Emitter(sio, "delete_message")
+update_user_emitter = Emitter(sio, "update_user")
+sms_status_emitter = Emitter(sio, "sms_status")
+
+user_context = UserContext()
+
+# Hot response payloads skip the generic recursive encoder
+register_serializer(ChatMessage, TokensRead, Tokens, User, TariffRead)
+
+
+async def join_user_room(sid: str, user: User) -> None:
+    """
+    Subscribe a socket to the events of its user, on whatever worker they are emitted
+
+    :param sid:
+    :param user:
+    :return:
+    """
+    # AsyncServer.enter_room is a coroutine since python-socketio 5.10
+    result = sio.enter_room(sid, room=user.id)
+    if inspect.isawaitable(result):
+        await result
+
+
+async def emit_messages(messages: list[ChatMessage], room) -> None:
+    """
+    Announce new messages of a user, as one add_messages packet when batching is enabled
+
+    :param messages: in chronological order
+    :param room:
+    :return:
+    """
+    if CONFIG.chat_batch_emits and len(messages) > 1:
+        await add_messages_emitter.emit(WSResponse(status=200, type="info", data=messages), room=room)
+        return
+
+    for msg in messages:
+        await add_message_emitter.emit(WSResponse(status=200, type="info", data=msg), room=room)
+
+
+async def user_changed(user: User) -> None:
+    """
+    Refresh the user on this worker's sockets and drop it on the other workers
 
-connect_emitter = sio.create_emitter("auth", model=WSResponse)
-add_message_emitter = sio.create_emitter("add_message", model=WSResponse)
+    :param user: saved user document
+    :return:
+    """
+    user_context.update(user)
+    promo.promocodes.invalidate_user(user.id)
+    await cluster.broker.publish("user", str(user.id))
 
 
 def authorized(func):
-    def wrapper(sid, *args, **kwargs):
-        session = asyncio.run(sio.get_session(sid))
+    """
+    Socket.IO auth guard. Resolves the session and the user once per event and passes them
+    to the handler as ``session`` and ``user`` keyword arguments. The token is verified in-process
+    and the user is served from the per-connection context, the database is only queried
+    when the context is empty
+
+    :param func: async event handler
+    :return: async wrapper
+    """
+    @functools.wraps(func)
+    async def wrapper(sid, *args, **kwargs):
+        session = await sessions.get(sid)
 
         if not session:
-            return jsonable_encoder(
+            return encode_response(
                 WSResponse(
                     status=404,
                     type="error",
@@ -47,7 +122,7 @@ def authorized(func):
             )
 
         if not session.get("token"):
-            return jsonable_encoder(
+            return encode_response(
                 WSResponse(
                     status=401,
                     type="error",
@@ -55,8 +130,17 @@ def authorized(func):
                 )
             )
 
-        if not asyncio.run(token_auth.validate_token(session["token"])):
-            return jsonable_encoder(
+        user = user_context.get(sid)
+
+        if not user:
+            auth_data = await token_auth.authenticate(session["token"])
+
+            if auth_data and auth_data["user"]:
+                user = auth_data["user"]
+                user_context.bind(sid, user)
+
+        if not user or not await token_auth.validate_token(session["token"]):
+            return encode_response(
                 WSResponse(
                     status=401,
                     type="error",
@@ -64,11 +148,31 @@ def authorized(func):
                 )
             )
 
-        return asyncio.run(func(sid, *args, **kwargs))
+        return await func(sid, *args, session=session, user=user, **kwargs)
 
     return wrapper
 
 
+def report_sms_status(sid):
+    """
+    Creates a callback that reports the delivery status of a queued SMS to the socket
+
+    :param sid:
+    :return:
+    """
+    async def report(job: SMSJob):
+        await sms_status_emitter.emit(
+            WSResponse(
+                status=200 if job.status == "sent" else 503,
+                type="auth" if job.status == "sent" else "error",
+                data={"status": job.status, "details": job.error}
+            ),
+            to=sid
+        )
+
+    return report
+
+
 # Connect & Disconnect
 @sio.on("connect")
 async def on_connect(sid, data: dict, auth: dict = None):
@@ -99,8 +203,9 @@ async def on_connect(sid, data: dict, auth: dict = None):
             )
             return
 
-        sio.enter_room(sid, room=auth_data["user"].id)
-        await sio.save_session(sid,
+        await join_user_room(sid, auth_data["user"])
+        user_context.bind(sid, auth_data["user"])
+        await sessions.save(sid,
                                {"token": auth["token"], "phone": auth_data["user"].phone, "can_send": False}
                                )
         print(f"Session {sid} authenticated")
@@ -116,16 +221,17 @@ async def on_connect(sid, data: dict, auth: dict = None):
 
 @sio.on("disconnect")
 async def on_disconnect(sid):
-    pass
+    user_context.unbind(sid)
+    await sessions.delete(sid)
 
 
 # Auth
 @sio.on("auth")
 async def sms_auth(sid, data=None) -> dict:
-    session: dict = await sio.get_session(sid)
+    session: dict = await sessions.get(sid)
 
     if not data or not await utils.validate_dict("phone", data):
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=400,
                 type="error",
@@ -134,7 +240,7 @@ async def sms_auth(sid, data=None) -> dict:
         )
 
     if "token" in session:
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=403,
                 type="error",
@@ -143,7 +249,7 @@ async def sms_auth(sid, data=None) -> dict:
         )
 
     if not session.get("can_send", True):
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=403,
                 type="error",
@@ -152,9 +258,9 @@ async def sms_auth(sid, data=None) -> dict:
         )
 
     try:
-        code = await sms.send_code(data["phone"])
+        code = await sms.send_code(data["phone"], on_status=report_sms_status(sid))
         if not code:
-            return jsonable_encoder(
+            return encode_response(
                 WSResponse(
                     status=403,
                     type="error",
@@ -163,7 +269,7 @@ async def sms_auth(sid, data=None) -> dict:
             )
 
         if not isinstance(code, UserAuthCodeInfo):
-            return jsonable_encoder(
+            return encode_response(
                 WSResponse(
                     status=500,
                     type="error",
@@ -172,7 +278,7 @@ async def sms_auth(sid, data=None) -> dict:
             )
 
     except SMSBaseException as e:
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=503,
                 type="error",
@@ -180,12 +286,12 @@ async def sms_auth(sid, data=None) -> dict:
             )
         )
 
-    await sio.save_session(sid, {"phone": data["phone"], "can_send": False})
-    await Limit(
-        phone=data["phone"]
-    ).create()
+    await sessions.save(sid, {"phone": data["phone"], "can_send": False})
+    phone_limit = Limit(phone=data["phone"])
+    await phone_limit.create()
+    expiry.schedule(Limit, phone_limit.expire)
 
-    return jsonable_encoder(
+    return encode_response(
         WSResponse(
             status=200,
             type="auth",
@@ -196,10 +302,10 @@ async def sms_auth(sid, data=None) -> dict:
 
 @sio.on("auth_retry")
 async def sms_auth_retry(sid, *args, **kwargs) -> dict:
-    session: dict = await sio.get_session(sid)
+    session: dict = await sessions.get(sid)
 
     if not session:
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=404,
                 type="error",
@@ -208,7 +314,7 @@ async def sms_auth_retry(sid, *args, **kwargs) -> dict:
         )
 
     if session.get("can_send"):
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=400,
                 type="error",
@@ -217,7 +323,7 @@ async def sms_auth_retry(sid, *args, **kwargs) -> dict:
         )
 
     if not await sms.can_send_code(session["phone"]):
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=403,
                 type="error",
@@ -228,7 +334,7 @@ async def sms_auth_retry(sid, *args, **kwargs) -> dict:
     phone_limit = await Limit.find_one(Limit.phone == session["phone"])
 
     if phone_limit.limit == 0:
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=403,
                 type="error",
@@ -240,9 +346,9 @@ async def sms_auth_retry(sid, *args, **kwargs) -> dict:
         )
 
     try:
-        code = await sms.send_code(session["phone"])
+        code = await sms.send_code(session["phone"], on_status=report_sms_status(sid))
     except SMSBaseException as e:
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=503,
                 type="error",
@@ -253,7 +359,7 @@ async def sms_auth_retry(sid, *args, **kwargs) -> dict:
     phone_limit.limit -= 1
     await phone_limit.update()
 
-    return jsonable_encoder(
+    return encode_response(
         WSResponse(
             status=200,
             type="auth",
@@ -264,10 +370,10 @@ async def sms_auth_retry(sid, *args, **kwargs) -> dict:
 
 @sio.on("auth_cancel")
 async def clean_phone(sid, *args, **kwargs) -> dict:
-    session: dict = await sio.get_session(sid)
+    session: dict = await sessions.get(sid)
 
     if not session:
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=404,
                 type="error",
@@ -275,8 +381,8 @@ async def clean_phone(sid, *args, **kwargs) -> dict:
             )
         )
 
-    await sio.save_session(sid, {"token": session["token"]} if session.get("token") else {})
-    return jsonable_encoder(
+    await sessions.save(sid, {"token": session["token"]} if session.get("token") else {})
+    return encode_response(
         WSResponse(
             status=200,
             type="auth",
@@ -287,10 +393,10 @@ async def clean_phone(sid, *args, **kwargs) -> dict:
 
 @sio.on("auth_confirm")
 async def auth(sid, data, *args, **kwargs):
-    session: dict = await sio.get_session(sid)
+    session: dict = await sessions.get(sid)
 
     if not session:
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=404,
                 type="error",
@@ -299,7 +405,7 @@ async def auth(sid, data, *args, **kwargs):
         )
 
     if not data.get("code"):
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=400,
                 type="error",
@@ -310,7 +416,7 @@ async def auth(sid, data, *args, **kwargs):
     auth_data = await user_auth.authenticate(data["code"])
 
     if not auth_data:
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=403,
                 type="error",
@@ -319,8 +425,9 @@ async def auth(sid, data, *args, **kwargs):
         )
 
     session["token"] = auth_data[0]["auth"].access_token
-    sio.enter_room(sid, room=auth_data[0]["user"].id)
-    await sio.save_session(sid, session)
+    await join_user_room(sid, auth_data[0]["user"])
+    user_context.bind(sid, auth_data[0]["user"])
+    await sessions.save(sid, session)
 
     print(auth_data[1])
 
@@ -347,7 +454,7 @@ async def auth(sid, data, *args, **kwargs):
         )
         print("send welcome")
 
-    return jsonable_encoder(
+    return encode_response(
         WSResponse(
             status=200,
             type="auth",
@@ -358,10 +465,12 @@ async def auth(sid, data, *args, **kwargs):
 
 @sio.on("logout")
 @authorized
-async def logout(sid, *args, **kwargs):
-    await sio.save_session(sid, {})
+async def logout(sid, *args, user: User, **kwargs):
+    await user_auth.logout(user)
+    user_context.unbind(sid)
+    await sessions.save(sid, {})
 
-    return jsonable_encoder(
+    return encode_response(
         WSResponse(
             status=200,
             type="info",
@@ -373,46 +482,28 @@ async def logout(sid, *args, **kwargs):
 # User update
 @sio.on("set_name")
 @authorized
-async def set_username(sid, name=None):
+async def set_username(sid, name=None, *, user: User, **kwargs):
     if not name:
         return
-    session = await sio.get_session(sid)
-
-    user = await User.get_by_phone(session["phone"])
 
     user_has_name = True
 
     if not user.name:
         user_has_name = False
 
-    user.name = name["name"]
-    await user.save()
+    # Only the name: the cached document may predate a payment saved by another worker
+    await user.set({User.name: name["name"]})
+    await user_changed(user)
 
     if not user_has_name:
-        msg_id = await chat.add_message(user, message=user.name, role="user")
-        msg_id_2 = await chat.add_message(user, message=f"Привет, {user.name}! Я твой голосовой помощник",
-                                          role="assistant")
-
-        await add_message_emitter.emit(
-            WSResponse(
-                status=200,
-                type="info",
-                data=await chat.get_message(user, msg_id)
-            ),
-            room=user.id
-        )
+        msg, msg_2 = await chat.add_messages(user, [
+            {"message": user.name, "role": "user"},
+            {"message": f"Привет, {user.name}! Я твой голосовой помощник", "role": "assistant"}
+        ])
 
-        await add_message_emitter.emit(
-            WSResponse(
-                status=200,
-                type="info",
-                data=await chat.get_message(user, msg_id_2)
-            ),
-            room=user.id
-        )
+        await emit_messages([msg, msg_2], room=user.id)
 
-    emitter = sio.create_emitter("update_user", model=WSResponse)
-    await emitter.emit(
+    await update_user_emitter.emit(
         WSResponse(
             status=200,
             type="info",
@@ -420,7 +511,7 @@ async def set_username(sid, name=None):
         ),
         room=user.id
     )
-    return jsonable_encoder(
+    return encode_response(
         WSResponse(
             status=200,
             type="info"
@@ -443,55 +534,115 @@ async def get_app_version(sid, *args, **kwargs):
 # Chat
 @sio.on("get_messages")
 @authorized
-async def get_messages(sid, options: dict = None):
+async def get_messages(sid, options: dict = None, *, user: User, **kwargs):
     if not options:
         options = dict()
 
-    session = await sio.get_session(sid)
+    # Keyset pagination is opt-in: older clients send start/end or nothing and get a list of messages
+    if not any(key in options for key in ("before", "after", "cursor", "limit")):
+        try:
+            messages = await chat.get_messages_selection(user, options.get("start"), options.get("end"), raw=True)
+        except chat.InvalidRange:
+            return encode_response(
+                WSResponse(
+                    status=400,
+                    type="error",
+                    data={"details": "Incorrect range"}
+                )
+            )
 
-    user = await User.get_by_phone(session["phone"])
+        return encode_response(
+            WSResponse(
+                status=200,
+                type="info",
+                data=messages
+            )
+        )
 
-    messages = await chat.get_messages_selection(user, options.get("start"), options.get("end"))
+    try:
+        messages, cursor = await chat.get_messages_page(
+            user,
+            before=options.get("before"),
+            after=options.get("after"),
+            cursor=options.get("cursor"),
+            limit=options.get("limit"),
+            raw=True
+        )
+    except chat.InvalidCursor:
+        return encode_response(
+            WSResponse(
+                status=400,
+                type="error",
+                data={"details": "Incorrect cursor"}
+            )
+        )
 
-    return jsonable_encoder(
+    return encode_response(
         WSResponse(
             status=200,
             type="info",
-            data=messages
+            data={"messages": messages, "cursor": cursor}
         )
     )
 
 
 @sio.on("add_message")
 @authorized
-async def add_message(sid, message: dict = None):
+async def add_message(sid, message: dict = None, *, user: User, **kwargs):
     if not message or not message.get("text"):
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=400,
                 type="error",
                 data={"details": "Incorrect message!"}
             )
         )
-    session = await sio.get_session(sid)
 
-    user = await User.get_by_phone(session["phone"])
-    msg = await chat.get_message(user, await chat.add_message(user, message["text"]))
+    try:
+        async with gpt_scheduler.turn(user) as ticket:
+            msg = await chat.add_message(user, message["text"])
 
-    await add_message_emitter.emit(
-        WSResponse(
-            status=200,
-            type="info",
-            data=msg
-        ),
-        room=user.id
-    )
+            await add_message_emitter.emit(
+                WSResponse(
+                    status=200,
+                    type="info",
+                    data=msg
+                ),
+                room=user.id
+            )
 
-    answer = await gpt.ask_with_context(user, message["text"])
+            async with ticket.slot():
+                answer, bot_msg_id, dropped = await ask_gpt(user, message)
 
-    bot_msg_id = await chat.add_message(user, answer, role="assistant")
+            msg = await chat.add_message(user, answer, role="assistant", msg_id=bot_msg_id)
+    except RateLimited as e:
+        if e.retry_after is None:
+            return encode_response(
+                WSResponse(
+                    status=403,
+                    type="error",
+                    data={"details": "Messages are not available on your tariff"}
+                )
+            )
 
-    msg = await chat.get_message(user, bot_msg_id)
+        return encode_response(
+            WSResponse(
+                status=429,
+                type="error",
+                data={"details": "Too many messages, try again later", "retry_after": round(e.retry_after, 1)}
+            )
+        )
+    except RateLimitError as e:
+        retry_after = e.retry_after or CONFIG.gpt_upstream_pause
+        gpt_scheduler.pause(retry_after)
+
+        return encode_response(
+            WSResponse(
+                status=429,
+                type="error",
+                data={"details": "ChatGPT is overloaded, try again later", "retry_after": round(retry_after, 1)}
+            )
+        )
 
     await add_message_emitter.emit(
         WSResponse(
@@ -502,20 +653,52 @@ async def add_message(sid, message: dict = None):
         room=user.id
     )
 
-    return jsonable_encoder(
+    return encode_response(
         WSResponse(
             status=200,
             type="info",
-            data={"details": f"Added message"}
+            # Earlier messages the answer was given without: they did not fit into the context budget
+            data={"details": f"Added message", "context_dropped": [str(msg_id) for msg_id in dropped]}
         )
     )
 
 
+async def ask_gpt(user: User, message: dict) -> tuple[str, Optional[PydanticObjectId], list[PydanticObjectId]]:
+    """
+    Ask ChatGPT, streaming the answer as add_message_chunk events if requested
+
+    :param user:
+    :param message: add_message payload
+    :return: answer, the id announced with its chunks and the turns cut off from the context
+    """
+    context = await gpt.build_context(user, message["text"])
+
+    if not message.get("stream", CONFIG.gpt_stream):
+        return await gpt.complete(context.messages), None, context.dropped
+
+    # The answer is announced chunk by chunk under the id it is stored with afterwards
+    bot_msg_id = PydanticObjectId()
+    chunks = []
+
+    async for delta in gpt.stream(context.messages):
+        chunks.append(delta)
+        await add_message_chunk_emitter.emit(
+            WSResponse(
+                status=200,
+                type="info",
+                data={"id": str(bot_msg_id), "text": delta}
+            ),
+            room=user.id
+        )
+
+    return "".join(chunks), bot_msg_id, context.dropped
+
+
 @sio.on("delete_message")
 @authorized
-async def delete_message(sid, message: dict = None):
+async def delete_message(sid, message: dict = None, *, user: User, **kwargs):
     if not message or not message.get("id"):
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=400,
                 type="error",
@@ -523,15 +706,10 @@ async def delete_message(sid, message: dict = None):
             )
         )
 
-    session = await sio.get_session(sid)
-
-    user = await User.get_by_phone(session["phone"])
-
     try:
         msg_id = await chat.delete_message(user, message["id"])
 
-        emitter = sio.create_emitter("delete_message", model=WSResponse)
-        await emitter.emit(
+        await delete_message_emitter.emit(
             WSResponse(
                 status=204,
                 type="info",
@@ -540,7 +718,7 @@ async def delete_message(sid, message: dict = None):
             room=user.id
         )
 
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=200,
                 type="info",
@@ -548,7 +726,7 @@ async def delete_message(sid, message: dict = None):
             )
         )
     except chat.MessageNotFound:
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=404,
                 type="error",
@@ -560,39 +738,21 @@ async def delete_message(sid, message: dict = None):
 # ChatGPT
 @sio.on("clear_context")
 @authorized
-async def clear_gpt_context(sid, *args, **kwargs):
-    session = await sio.get_session(sid)
-
-    user = await User.get_by_phone(session["phone"])
-
-    user_msg = await chat.get_message(user, await chat.add_message(user, "Забудь"))
-    msg = await chat.get_message(user, await chat.add_message(user, "Хорошо, я всё забыла", role="assistant"))
-
-    await add_message_emitter.emit(
-        WSResponse(
-            status=200,
-            type="info",
-            data=user_msg
-        ),
-        room=user.id
-    )
+async def clear_gpt_context(sid, *args, user: User, **kwargs):
+    user_msg, msg = await chat.add_messages(user, [
+        {"message": "Забудь", "reset": True},
+        {"message": "Хорошо, я всё забыла", "role": "assistant"}
+    ])
 
-    await add_message_emitter.emit(
-        WSResponse(
-            status=200,
-            type="info",
-            data=msg
-        ),
-        room=user.id
-    )
+    await emit_messages([user_msg, msg], room=user.id)
 
 
 # Payments
 @sio.on("get_promocode")
 @authorized
-async def get_promocode(sid, promocode: dict = None):
+async def get_promocode(sid, promocode: dict = None, **kwargs):
     if not promocode or not promocode.get("promocode"):
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=400,
                 type="error",
@@ -603,7 +763,7 @@ async def get_promocode(sid, promocode: dict = None):
     try:
         db_promocode = await promo.get_promocode(promocode["promocode"])
     except promo.PromocodeNotFound:
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=404,
                 type="error",
@@ -611,7 +771,7 @@ async def get_promocode(sid, promocode: dict = None):
             )
         )
     except promo.UserSubscriptionInvalid:
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=403,
                 type="error",
@@ -619,7 +779,7 @@ async def get_promocode(sid, promocode: dict = None):
             )
         )
 
-    return jsonable_encoder(
+    return encode_response(
         WSResponse(
             status=200,
             type="payment",
@@ -628,20 +788,25 @@ async def get_promocode(sid, promocode: dict = None):
     )
 
 
+@sio.on("get_tariffs")
+async def get_tariffs(sid, *args, **kwargs):
+    return tariff_catalog.response()
+
+
 @sio.on("new_order")
 @authorized
-async def create_order(sid, order: dict = None):
+async def create_order(sid, order: dict = None, *, user: User, **kwargs):
     if not order or not order.get("tariff"):
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=400,
                 type="error",
                 data={"details": "Incorrect order"}
             )
         )
-    tariff = await Tariff.find_one(Tariff.name == order["tariff"])
+    tariff = tariff_catalog.get(order["tariff"])
     if not tariff:
-        return jsonable_encoder(
+        return encode_response(
             WSResponse(
                 status=404,
                 type="error",
@@ -654,7 +819,7 @@ async def create_order(sid, order: dict = None):
         try:
             promocode = await promo.get_promocode(order["promocode"])
         except promo.PromocodeNotFound:
-            return jsonable_encoder(
+            return encode_response(
                 WSResponse(
                     status=404,
                     type="error",
@@ -662,7 +827,7 @@ async def create_order(sid, order: dict = None):
                 )
             )
         except promo.UserSubscriptionInvalid:
-            return jsonable_encoder(
+            return encode_response(
                 WSResponse(
                     status=403,
                     type="error",
@@ -670,9 +835,6 @@ async def create_order(sid, order: dict = None):
                 )
             )
 
-    session = await sio.get_session(sid)
-    user = await User.get_by_phone(session["phone"])
-
     summa = int(tariff.sum - (tariff.sum / 100) * promocode.sale) if promocode else tariff.sum
     order = Order(user=user,
                   tariff=tariff,
@@ -680,7 +842,7 @@ async def create_order(sid, order: dict = None):
                   sum=summa)
     await order.create()
 
-    return jsonable_encoder(
+    return encode_response(
         WSResponse(
             status=200,
             type="payment",
@@ -711,24 +873,58 @@ async def tinkoff_notification(**data):
     if not order:
         return
 
-    user = order.user
-    user.tariff = order.tariff.name
-    user.tariff_expiration = datetime.utcnow() + order.tariff.duration \
-        if promo.check_user_sub(user, "free") \
-        else user.tariff_expiration + order.tariff.duration
-    await user.update()
+    # The tariff comes from the catalog, only the user is read
+    user = await User.get(order.user.ref.id)
+    tariff = await tariff_catalog.find(order.tariff.ref.id)
+    user.tariff_expire = datetime.utcnow() + tariff.duration \
+        if await promo.check_user_sub(user, "free") \
+        else user.tariff_expire + tariff.duration
+    user.tariff = tariff.name
+    await user.save()
+    await user_changed(user)
 
     if order.promocode:
-        promo_user = (await promo.get_promocode(order.promocode)).user
+        promo_user = (await promo.get_promocode(order.promocode, cached=False)).user
         promo_user.balance += 100
-        await promo_user.update()
+        await promo_user.save()
+        await user_changed(promo_user)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
 
 
 @app.on_event("startup")
 async def startup():
-    await db.init_db([UserAuthCode, User, Message, Tokens, Limit, Tariff, Order])
-    nest_asyncio.apply()
+    await db.init_db([UserAuthCode, User, Message, Tokens, RevokedToken, Limit, Tariff, Order,
+                      PromocodeReservation])
+    await token_auth.revoked_tokens.refresh()
+    await tariff_catalog.start()
+    await promo.promocodes.refresh()
+    await promo.promocode_allocator.refill()
+    expiry.watch(UserAuthCode)
+    expiry.watch(Limit)
+    await expiry.start()
+    await sms.dispatcher.start()
+    cluster.broker.subscribe("user", lambda user_id: user_context.invalidate(PydanticObjectId(user_id)))
+    cluster.broker.subscribe("user", lambda user_id: promo.promocodes.invalidate_user(PydanticObjectId(user_id)))
+    cluster.broker.subscribe("promocode", promo.promocodes.add)
+    cluster.broker.subscribe("conversation",
+                             lambda user_id: chat.conversations.invalidate(PydanticObjectId(user_id)))
+    await cluster.broker.start()
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(sms.check_codes, trigger=IntervalTrigger(seconds=1))
-    scheduler.add_job(sms.check_limit, trigger=IntervalTrigger(seconds=1))
+    scheduler.add_job(token_auth.revoked_tokens.refresh,
+                      trigger=IntervalTrigger(seconds=CONFIG.auth_revocation_refresh))
+    scheduler.add_job(promo.promocodes.refresh, trigger=IntervalTrigger(seconds=CONFIG.promocode_refresh))
     scheduler.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await expiry.stop()
+    await sms.dispatcher.stop()
+    await cluster.broker.stop()
+    await tariff_catalog.stop()
+    await sms.sms.close()
+    db.close_db()
@@ -0,0 +1,93 @@
+from collections import deque
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value) -> None:
+        self.value = value
+
+    def inc(self, amount=1) -> None:
+        self.value += amount
+
+    def dec(self, amount=1) -> None:
+        self.value -= amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Summary:
+    """
+    Count, sum, max and percentiles over the last ``window`` observations
+    """
+
+    def __init__(self, window: int = 1024):
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+        self._window = deque(maxlen=window)
+
+    def observe(self, value) -> None:
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self._window.append(value)
+
+    def percentile(self, p: float):
+        if not self._window:
+            return 0
+        values = sorted(self._window)
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+        }
+
+
+class Metrics:
+    """
+    Process-local metrics registry. Metrics are created on first use
+    """
+
+    def __init__(self):
+        self._metrics: dict[str, Counter | Gauge | Summary] = {}
+
+    def _get(self, name: str, kind):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = kind()
+        return metric
+
+    def counter(self, name: str) -> Counter:
+        return self._get(name, Counter)
+
+    def gauge(self, name: str) -> Gauge:
+        return self._get(name, Gauge)
+
+    def summary(self, name: str) -> Summary:
+        return self._get(name, Summary)
+
+    def snapshot(self) -> dict:
+        return {name: metric.snapshot() for name, metric in sorted(self._metrics.items())}
+
+
+metrics = Metrics()
@@ -0,0 +1,138 @@
+import asyncio
+from typing import Optional
+
+from beanie import PydanticObjectId
+from beanie.odm.utils.parsing import parse_obj
+from pymongo.errors import OperationFailure, PyMongoError
+
+from app.config import CONFIG
+from app.database import read_collection
+from app.metrics import metrics
+from app.payments.models import Tariff, TariffRead
+from app.schemas import WSResponse, encode_response
+
+# "The $changeStream stage is only supported on replica sets"
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
+
+class TariffCatalog:
+    """
+    Process-local copy of the tariffs, indexed by name and id.
+
+    Loaded at startup and reloaded as a whole on every change of the collection, seen through
+    a change stream. Change streams need a replica set, on a standalone server the catalog
+    is reloaded every ``poll_interval`` seconds instead.
+    """
+
+    retry_delay = 5
+
+    def __init__(self, poll_interval: float = 60):
+        self.poll_interval = poll_interval
+        self._by_name: dict[str, Tariff] = {}
+        self._by_id: dict[PydanticObjectId, Tariff] = {}
+        self._response: Optional[dict] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def get(self, name: str) -> Optional[Tariff]:
+        return self._by_name.get(name)
+
+    def get_by_id(self, tariff_id: PydanticObjectId) -> Optional[Tariff]:
+        return self._by_id.get(tariff_id)
+
+    async def find(self, tariff_id: PydanticObjectId) -> Optional[Tariff]:
+        """
+        By id, reloading once on a miss: an order may come from a worker that has seen a newer catalog
+
+        :param tariff_id:
+        :return:
+        """
+        tariff = self._by_id.get(tariff_id)
+        if tariff is None:
+            await self.load("primary")
+            tariff = self._by_id.get(tariff_id)
+
+        return tariff
+
+    def response(self) -> dict:
+        """
+        The encoded get_tariffs answer, built once per catalog version
+
+        :return:
+        """
+        if self._response is None:
+            tariffs = sorted(self._by_id.values(), key=lambda tariff: tariff.sum)
+            self._response = encode_response(
+                WSResponse(
+                    status=200,
+                    type="payment",
+                    data=[TariffRead.from_tariff(tariff) for tariff in tariffs]
+                )
+            )
+
+        return self._response
+
+    async def load(self, profile: str = "catalog") -> int:
+        """
+        Replace the catalog with the tariffs in the database
+
+        :param profile: read profile. Reloads after a change or a miss read the primary: a lagging
+                        secondary would return the old tariffs and nothing would correct them later
+        :return: number of tariffs
+        """
+        tariffs = [parse_obj(Tariff, doc) async for doc in read_collection(Tariff, profile).find()]
+
+        self._by_name = {tariff.name: tariff for tariff in tariffs}
+        self._by_id = {tariff.id: tariff for tariff in tariffs}
+        self._response = None
+
+        metrics.counter("catalog.reloads").inc()
+        metrics.gauge("catalog.tariffs").set(len(tariffs))
+        return len(tariffs)
+
+    async def start(self) -> None:
+        await self.load()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _watch(self) -> None:
+        async with Tariff.get_motor_collection().watch() as stream:
+            # Changes made before the stream was opened
+            await self.load("primary")
+
+            async for _ in stream:
+                await self.load("primary")
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self.load()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._watch()
+            except PyMongoError as e:
+                if isinstance(e, OperationFailure) and e.code == CHANGE_STREAMS_UNSUPPORTED:
+                    print(f"Tariff catalog: no change streams, reloading every {self.poll_interval} s")
+                    break
+
+                metrics.counter("catalog.errors").inc()
+                print(f"Tariff catalog change stream failed: {e}")
+                await asyncio.sleep(self.retry_delay)
+
+        while True:
+            try:
+                await self._poll()
+            except PyMongoError as e:
+                metrics.counter("catalog.errors").inc()
+                print(f"Tariff catalog reload failed: {e}")
+
+
+tariff_catalog = TariffCatalog(poll_interval=CONFIG.tariff_poll_interval)
@@ -1,4 +1,4 @@
-from beanie import Document, Link
+from beanie import Document, Indexed, Link
 from pydantic import BaseModel
 from datetime import datetime, timedelta
 from app.auth.models.user import User
@@ -6,7 +6,7 @@ from app.auth.models.user import User
 
 class Tariff(Document):
     sum: float
-    name: str
+    name: Indexed(str)
     duration: timedelta = timedelta(days=30)
 
 
@@ -21,6 +21,25 @@ class Order(Document):
         return self.id.generation_time
 
 
+class TariffRead(BaseModel):
+    id: str
+    name: str
+    sum: float
+    # Days
+    duration: int
+
+    @classmethod
+    def from_tariff(cls, tariff: Tariff) -> "TariffRead":
+        return cls(id=str(tariff.id), name=tariff.name, sum=tariff.sum, duration=tariff.duration.days)
+
+
+class PromocodeReservation(Document):
+    """
+    A promocode handed to an allocator. The unique index lets every code be reserved once, across workers
+    """
+    code: Indexed(str, unique=True)
+
+
 class OrderRead(BaseModel):
     id: str
     user_id: str
@@ -1,10 +1,23 @@
-
+import asyncio
+import hashlib
+import math
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
 from enum import Enum
+from typing import Optional
 
 from pydantic import BaseModel
-from beanie import Link
+from beanie import PydanticObjectId
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
 
-from app.auth.models.user import User
+from app.auth.models.user import User, generate_promocode
+from app.cluster import broker
+from app.config import CONFIG
+from app.database import Watermark, find_one, read_collection
+from app.metrics import metrics
+from app.payments.models import PromocodeReservation
 
 
 class UserSubscriptions(Enum):
@@ -34,6 +47,335 @@ class UserSubscriptionInvalid(Exception):
     """Invalid user subscribtion"""
 
 
+class PromocodeAllocationFailed(Exception):
+    """No promocode could be reserved"""
+
+
+class BloomFilter:
+    """
+    Set membership without false negatives: ``code in bloom`` is False only for codes never added
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value: str):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, value: str) -> None:
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class PromocodeResolver:
+    """
+    Promocode lookups that stay cheap under probing.
+
+    Codes missing from a bloom filter of all existing codes are rejected without I/O. The rest are
+    looked up once and cached for ``ttl`` seconds, misses (bloom false positives) included.
+    Codes of users created on this worker are added to the filter at once and announced to the other
+    workers, refresh() pulls the codes created since the last refresh as a fallback.
+    A change of the owner (tariff) drops the cached entry.
+    """
+
+    def __init__(self, size: int = 10000, ttl: float = 30, error_rate: float = 0.01):
+        self.size = size
+        self.ttl = ttl
+        self.error_rate = error_rate
+        self.bloom: Optional[BloomFilter] = None
+
+        self._entries: OrderedDict[str, tuple[float, Optional[Promocode]]] = OrderedDict()
+        self._codes: dict[PydanticObjectId, str] = {}
+        self._watermark = Watermark()
+        # Codes added while a rebuild is loading, they may be missing from its snapshot
+        self._added_during_rebuild: Optional[list[str]] = None
+
+    async def _load(self, since: Optional[ObjectId] = None) -> list[str]:
+        query = {"promocode": {"$ne": None}}
+        if since is not None:
+            query["_id"] = {"$gte": since}
+
+        # From the primary: a code missed on a lagging secondary would be rejected until the next rebuild
+        cursor = read_collection(User, "primary").find(query, projection={"_id": False, "promocode": True})
+        return [doc["promocode"] async for doc in cursor]
+
+    async def refresh(self) -> int:
+        """
+        Add the codes created since the last refresh to the filter, or build the filter from scratch
+        on the first call and when it has outgrown its capacity
+
+        :return: number of loaded codes
+        """
+        now = datetime.utcnow()
+        rebuild = self.bloom is None or self.bloom.count > self.bloom.capacity
+
+        if rebuild:
+            self._added_during_rebuild = []
+            try:
+                codes = await self._load()
+                added = self._added_during_rebuild
+            finally:
+                self._added_during_rebuild = None
+
+            bloom = BloomFilter(max(2 * len(codes), 10000), self.error_rate)
+            for code in codes + added:
+                bloom.add(code)
+            self.bloom = bloom
+        else:
+            codes = await self._load(self._watermark.since())
+            for code in codes:
+                self.add(code)
+
+        self._watermark.advance(now)
+        metrics.gauge("promocode.bloom.codes").set(self.bloom.count)
+        return len(codes)
+
+    def add(self, code: Optional[str]) -> None:
+        """
+        A new code exists: let it pass the filter and forget a cached miss
+
+        :param code:
+        :return:
+        """
+        if not code:
+            return
+        if self.bloom is not None and code not in self.bloom:
+            self.bloom.add(code)
+        if self._added_during_rebuild is not None:
+            self._added_during_rebuild.append(code)
+        self._entries.pop(code, None)
+
+    async def register(self, user: User) -> None:
+        """
+        Announce the code of a new user to every worker
+
+        :param user:
+        :return:
+        """
+        if not user.promocode:
+            return
+
+        self.add(user.promocode)
+        await broker.publish("promocode", user.promocode)
+
+    def invalidate_user(self, user_id: PydanticObjectId) -> None:
+        """
+        The owner has changed, the next lookup of the code reads it again
+
+        :param user_id:
+        :return:
+        """
+        code = self._codes.pop(user_id, None)
+        if code:
+            self._entries.pop(code, None)
+
+    def _cached(self, code: str):
+        entry = self._entries.get(code)
+        if entry is None:
+            return None
+
+        if entry[0] < time.monotonic():
+            self._drop(code)
+            return None
+
+        self._entries.move_to_end(code)
+        return entry
+
+    def _drop(self, code: str) -> None:
+        _, promocode = self._entries.pop(code)
+        if promocode:
+            self._codes.pop(promocode.user.id, None)
+
+    def _put(self, code: str, promocode: Optional[Promocode]) -> None:
+        self._entries[code] = (time.monotonic() + self.ttl, promocode)
+        self._entries.move_to_end(code)
+        if promocode:
+            self._codes[promocode.user.id] = code
+
+        while len(self._entries) > self.size:
+            self._drop(next(iter(self._entries)))
+
+    async def resolve(self, code: str) -> Optional[Promocode]:
+        """
+        :param code:
+        :return: None if there is no such code
+        """
+        if not isinstance(code, str) or not code:
+            return None
+
+        if self.bloom is not None and code not in self.bloom:
+            metrics.counter("promocode.bloom_rejected").inc()
+            return None
+
+        entry = self._cached(code)
+        if entry is not None:
+            metrics.counter("promocode.cache_hits").inc()
+            return entry[1]
+
+        metrics.counter("promocode.lookups").inc()
+        # From the primary: a code created moments ago passes the filter, a lagging secondary
+        # would miss it and the miss would be cached for the TTL
+        user = await find_one("primary", User, User.promocode == code)
+        promocode = Promocode(value=user.promocode, user=user) if user else None
+
+        self._put(code, promocode)
+        return promocode
+
+
+promocodes = PromocodeResolver(
+    size=CONFIG.promocode_cache_size,
+    ttl=CONFIG.promocode_cache_ttl,
+    error_rate=CONFIG.promocode_bloom_error
+)
+
+
+class PromocodeAllocator:
+    """
+    Unique promocodes for new users, served from a pool of reserved codes.
+
+    Codes are reserved in batches: random candidates are inserted into the reservations collection
+    unordered, and its unique index decides between workers. Colliding candidates are dropped and
+    only the shortfall is generated again, at most ``max_attempts`` rounds per batch. The pool is
+    refilled in the background once it falls to ``low_water``, so a signup takes a code from memory
+    and never sees a collision.
+    """
+
+    def __init__(self, batch: int = 200, low_water: int = 50, length: int = 10, max_attempts: int = 5):
+        self.batch = batch
+        self.low_water = low_water
+        self.length = length
+        self.max_attempts = max_attempts
+
+        self._pool: deque[str] = deque()
+        self._refill: Optional[asyncio.Task] = None
+        self._waiting = 0
+
+    def __len__(self):
+        return len(self._pool)
+
+    async def _taken(self, candidates: set[str]) -> set[str]:
+        # Codes of users created before reservations, they are not in the reservations collection
+        cursor = User.get_motor_collection().find(
+            {"promocode": {"$in": list(candidates)}}, projection={"_id": False, "promocode": True}
+        )
+        return {doc["promocode"] async for doc in cursor}
+
+    async def _insert(self, candidates: set[str]) -> set[str]:
+        """
+        :param candidates:
+        :return: candidates that are reserved now
+        """
+        codes = list(candidates)
+        try:
+            await PromocodeReservation.get_motor_collection().insert_many(
+                [{"code": code} for code in codes], ordered=False
+            )
+        except BulkWriteError as e:
+            errors = e.details["writeErrors"]
+            if any(error["code"] != 11000 for error in errors):
+                raise
+
+            metrics.counter("promocode.allocator.collisions").inc(len(errors))
+            return candidates - {codes[error["index"]] for error in errors}
+
+        return candidates
+
+    async def reserve(self, count: int) -> list[str]:
+        """
+        Reserve ``count`` codes that no user or other worker has
+
+        :param count:
+        :return: reserved codes, fewer than ``count`` only if every attempt collided
+        """
+        started = time.perf_counter()
+        reserved: set[str] = set()
+
+        for _ in range(self.max_attempts):
+            candidates = {generate_promocode(self.length) for _ in range(count - len(reserved))} - reserved
+            candidates -= await self._taken(candidates)
+            if candidates:
+                reserved |= await self._insert(candidates)
+
+            if len(reserved) >= count:
+                break
+
+        elapsed = time.perf_counter() - started
+        metrics.counter("promocode.allocator.reserved").inc(len(reserved))
+        metrics.summary("promocode.allocator.reserve_seconds").observe(elapsed)
+        metrics.gauge("promocode.allocator.reserved_per_second").set(len(reserved) / elapsed if elapsed else 0)
+        return list(reserved)
+
+    def _start_refill(self) -> asyncio.Task:
+        if self._refill is None or self._refill.done():
+            self._refill = asyncio.create_task(self._reserve_batch())
+            self._refill.add_done_callback(self._report)
+        return self._refill
+
+    async def refill(self) -> int:
+        """
+        Top the pool up by a batch, joining the refill in progress if there is one
+
+        :return: number of codes added
+        """
+        return await asyncio.shield(self._start_refill())
+
+    async def _reserve_batch(self) -> int:
+        # A signup spike waiting on an empty pool is served by one batch
+        codes = await self.reserve(max(self.batch, self._waiting))
+        self._pool.extend(codes)
+        metrics.gauge("promocode.allocator.pool").set(len(self._pool))
+        return len(codes)
+
+    @staticmethod
+    def _report(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception():
+            metrics.counter("promocode.allocator.errors").inc()
+            print(f"Promocode refill failed: {task.exception()}")
+
+    async def allocate(self) -> str:
+        """
+        :return: a promocode nobody has
+        :raises PromocodeAllocationFailed: ``max_attempts`` refills in a row gave no codes
+        """
+        empty_refills = 0
+        self._waiting += 1
+        try:
+            # Codes taken by other waiters do not count, only refills that reserved nothing
+            while not self._pool:
+                if empty_refills == self.max_attempts:
+                    raise PromocodeAllocationFailed
+                if not await self.refill():
+                    empty_refills += 1
+        finally:
+            self._waiting -= 1
+
+        code = self._pool.popleft()
+        metrics.counter("promocode.allocator.allocated").inc()
+        metrics.gauge("promocode.allocator.pool").set(len(self._pool))
+
+        if len(self._pool) <= self.low_water:
+            self._start_refill()
+
+        return code
+
+
+promocode_allocator = PromocodeAllocator(
+    batch=CONFIG.promocode_batch,
+    low_water=CONFIG.promocode_low_water
+)
+
+
 async def check_user_sub(user: User, sub: str) -> bool:
     if sub not in [v.value for v in UserSubscriptions]:
         raise UserSubscriptionInvalid
@@ -44,13 +386,22 @@ async def check_user_sub(user: User, sub: str) -> bool:
     return False
 
 
-async def get_promocode(promocode: str) -> Promocode:
-    user = await User.find_one(User.promocode == promocode)
+async def get_promocode(promocode: str, cached: bool = True) -> Promocode:
+    """
+    :param promocode:
+    :param cached: False reads the owner from the database, for read-modify-write of the owner
+    :return:
+    """
+    if cached:
+        db_promocode = await promocodes.resolve(promocode)
+    else:
+        user = await find_one("primary", User, User.promocode == promocode)
+        db_promocode = Promocode(value=user.promocode, user=user) if user else None
 
-    if not user:
+    if not db_promocode:
         raise PromocodeNotFound
 
-    if await check_user_sub(user, "free"):
+    if await check_user_sub(db_promocode.user, "free"):
         raise UserSubscriptionInvalid
 
-    return Promocode(value=user.promocode, user=user)
+    return db_promocode
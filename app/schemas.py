@@ -1,9 +1,109 @@
-from typing import Union, Dict, Any, Optional
+from datetime import date, datetime
+from enum import Enum
+from typing import Dict, Any, Optional, Callable, Type
 
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
+from pydantic.fields import SHAPE_SINGLETON, ModelField
 
 
 class WSResponse(BaseModel):
     status: int
     type: str
     data: Optional[Any] = None
+
+
+Encoder = Callable[[Any], Any]
+
+
+def _plain(value: Any) -> Any:
+    return value
+
+
+def _isoformat(value: Optional[date]) -> Optional[str]:
+    return None if value is None else value.isoformat()
+
+
+def _string(value: Any) -> Optional[str]:
+    return None if value is None else str(value)
+
+
+def _field_encoder(field: ModelField) -> Encoder:
+    field_type = field.outer_type_
+
+    if field.shape == SHAPE_SINGLETON and isinstance(field_type, type) and not issubclass(field_type, Enum):
+        if issubclass(field_type, (str, int, float, bool)):
+            return _plain
+        if issubclass(field_type, (datetime, date)):
+            return _isoformat
+        if issubclass(field_type, ObjectId):
+            return _string
+
+    return jsonable_encoder
+
+
+class ModelSerializer:
+    """
+    Encoder of one model class, equal to jsonable_encoder(model) on its output.
+
+    Field names and value converters are resolved once per class instead of walking
+    every value of every instance through the generic recursive encoder.
+    """
+
+    def __init__(self, model: Type[BaseModel]):
+        hidden = model.get_hidden_fields() if hasattr(model, "get_hidden_fields") else set()
+
+        self.fields = [
+            (name, field.alias, _field_encoder(field))
+            for name, field in model.__fields__.items()
+            if name not in hidden
+        ]
+
+    def __call__(self, obj: BaseModel) -> dict:
+        return {alias: encode(getattr(obj, name)) for name, alias, encode in self.fields}
+
+
+_serializers: Dict[type, ModelSerializer] = {}
+
+
+def register_serializer(*models: Type[BaseModel]) -> None:
+    """
+    Enable the fast path for the models. Only for plain models: fields of simple types,
+    nested values fall back to jsonable_encoder
+
+    :param models:
+    :return:
+    """
+    for model in models:
+        _serializers[model] = ModelSerializer(model)
+
+
+def encode(data: Any) -> Any:
+    """
+    jsonable_encoder with precompiled serializers for the registered models
+
+    :param data:
+    :return:
+    """
+    serializer = _serializers.get(type(data))
+    if serializer:
+        return serializer(data)
+
+    if isinstance(data, (list, tuple)):
+        if data and type(data[0]) in _serializers:
+            serializer = _serializers[type(data[0])]
+            return [serializer(item) if type(item) is type(data[0]) else encode(item) for item in data]
+        return [encode(item) for item in data]
+
+    if isinstance(data, dict):
+        return {key if isinstance(key, str) else jsonable_encoder(key): encode(value) for key, value in data.items()}
+
+    if data is None or isinstance(data, (str, int, float, bool)) and not isinstance(data, Enum):
+        return data
+
+    return jsonable_encoder(data)
+
+
+def encode_response(response: WSResponse) -> dict:
+    return {"status": response.status, "type": response.type, "data": encode(response.data)}
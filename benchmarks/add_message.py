@@ -0,0 +1,126 @@
+"""
+End-to-end add_message latency with the stub LLM backend.
+
+Drives the real add_message handler of app.main (auth guard, GPT scheduler, context
+building, storage) for ``--users`` users sending ``--messages`` messages each, one after
+another, while the model is replaced with StubBackend latencies. Socket.IO emits are
+recorded instead of sent. Needs a local mongod, uses a throwaway database which is
+dropped afterwards.
+
+Usage: python -m benchmarks.add_message --users 50 --messages 5 --first-token lognormal:400:0.5
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import defaultdict
+
+from beanie import init_beanie
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import app.main as main
+from app.ai.backends import StubBackend
+from app.ai.chatgpt import gpt
+from app.ai.chatgpt.scheduler import GPTScheduler, parse_rate_limits
+from app.auth.models.auth import RevokedToken, Tokens
+from app.auth.models.limits import Limit
+from app.auth.models.user import User, UserAuthCode
+from app.chat.models import Message
+from app.config import CONFIG
+from app.database import DATABASE_URI
+from app.payments.models import Order, Tariff
+from benchmarks.util import percentile
+
+
+def summary(values: list[float]) -> dict:
+    return {f"p{round(p * 100)}_ms": round(percentile(values, p) * 1000, 1) for p in (0.5, 0.95, 0.99)}
+
+
+def patch_io(sessions: dict, first_chunk: dict) -> None:
+    async def get_session(sid, namespace=None):
+        return sessions[sid]
+
+    async def emit(event, data=None, room=None, to=None, **kwargs):
+        if event == "add_message_chunk" and data["data"]["id"] not in first_chunk:
+            first_chunk[data["data"]["id"]] = time.perf_counter()
+
+    main.sio._sio.get_session = get_session
+    main.sio._sio.emit = emit
+
+
+async def create_users(count: int, sessions: dict) -> list[str]:
+    sids = []
+    for i in range(count):
+        user = User(phone=f"8800{i:07d}", name="Ника", promocode=f"bench{i}")
+        await user.create()
+
+        tokens = await main.token_auth.create_tokens(user)
+        await Tokens(**tokens.dict(), user=user).create()
+
+        sid = f"sid-{i}"
+        sessions[sid] = {"token": tokens.access_token, "phone": user.phone, "can_send": False}
+        main.user_context.bind(sid, user)
+        sids.append(sid)
+
+    return sids
+
+
+async def run(args) -> dict:
+    client = AsyncIOMotorClient(args.uri)
+    await init_beanie(database=client[args.database],
+                      document_models=[UserAuthCode, User, Message, Tokens, RevokedToken, Limit, Tariff, Order])
+
+    gpt.backend = StubBackend(first_token=args.first_token, token_delay=args.token_delay, words=args.words,
+                              seed=args.seed)
+    main.gpt_scheduler = GPTScheduler(concurrency=args.concurrency, rates=parse_rate_limits(args.rate_limits),
+                                      burst=args.messages)
+    CONFIG.gpt_stream = args.stream
+
+    sessions, first_chunk = {}, {}
+    patch_io(sessions, first_chunk)
+    handler = main.sio._sio.handlers["/"]["add_message"]
+
+    latencies, statuses = [], defaultdict(int)
+
+    async def user_session(sid: str):
+        for i in range(args.messages):
+            started = time.perf_counter()
+            response = await handler(sid, {"text": f"Вопрос {i}"})
+            latencies.append(time.perf_counter() - started)
+            statuses[response["status"]] += 1
+
+    try:
+        sids = await create_users(args.users, sessions)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user_session(sid) for sid in sids))
+        elapsed = time.perf_counter() - started
+    finally:
+        await client.drop_database(args.database)
+
+    report = {
+        "messages": len(latencies),
+        "statuses": dict(statuses),
+        "messages_per_second": round(len(latencies) / elapsed, 1),
+        "latency": summary(latencies),
+    }
+    if args.stream:
+        report["first_chunks"] = len(first_chunk)
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uri", default=DATABASE_URI)
+    parser.add_argument("--database", default="nika_add_message")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=5, help="messages per user, sent one after another")
+    parser.add_argument("--concurrency", type=int, default=CONFIG.gpt_concurrency, help="GPT scheduler pool")
+    parser.add_argument("--rate-limits", default="default=100000", help="GPT scheduler limits, requests/minute")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--first-token", default="lognormal:400:0.5", help="ms")
+    parser.add_argument("--token-delay", default="fixed:20", help="ms")
+    parser.add_argument("--words", default="uniform:20:120")
+    parser.add_argument("--seed", type=int, default=0)
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2))
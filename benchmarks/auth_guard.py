@@ -0,0 +1,101 @@
+"""
+Events per second through the Socket.IO auth guard.
+
+Compares the legacy sync guard (``asyncio.run`` re-entering the loop through nest_asyncio)
+with the async ``authorized`` guard from app.main. Events are spread over ``--sockets``
+connections of one user holding a real access token. Session and user lookups are replaced
+with coroutines that sleep for ``--latency`` ms to simulate Mongo round trips, the token
+itself is verified by app.auth.tokens as in production.
+
+Usage: python -m benchmarks.auth_guard --events 2000 --concurrency 100 --sockets 100 --latency 2
+"""
+import argparse
+import asyncio
+import time
+
+from beanie import PydanticObjectId
+
+import app.main as main
+from app.auth.models.user import User
+
+
+def legacy_authorized(func):
+    def wrapper(sid, *args, **kwargs):
+        session = asyncio.run(main.sessions.get(sid))
+
+        if not session or not session.get("token"):
+            return None
+
+        if not asyncio.run(main.token_auth.authenticate(session["token"])):
+            return None
+
+        return asyncio.run(func(sid, *args, **kwargs))
+
+    return wrapper
+
+
+async def handler(sid, *args, **kwargs):
+    return {"status": 200}
+
+
+async def patch_io(latency: float) -> None:
+    # Not saved anywhere: construct() skips the collection check of beanie documents
+    user = User.construct(id=PydanticObjectId(), phone="88005553535", name="Ника", promocode="bench")
+    tokens = await main.token_auth.create_tokens(user)
+
+    async def get_session(sid):
+        await asyncio.sleep(latency)
+        return {"token": tokens.access_token, "phone": user.phone, "can_send": False}
+
+    async def authenticate(token):
+        await asyncio.sleep(latency)
+        return {"user": user, "auth": tokens}
+
+    main.sessions.get = get_session
+    main.token_auth.authenticate = authenticate
+
+
+async def dispatch(guarded, events: int, concurrency: int, sockets: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+    is_async = asyncio.iscoroutinefunction(guarded)
+
+    async def one(i):
+        async with semaphore:
+            # python-socketio awaits coroutine handlers and calls plain functions inline
+            if is_async:
+                response = await guarded(f"sid-{i % sockets}", {})
+            else:
+                response = guarded(f"sid-{i % sockets}", {})
+
+            if not response or response["status"] != 200:
+                raise RuntimeError(f"Guard rejected the event: {response}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(events)))
+    return events / (time.perf_counter() - started)
+
+
+async def run(args):
+    await patch_io(args.latency / 1000)
+
+    rate = await dispatch(main.authorized(handler), args.events, args.concurrency, args.sockets)
+    print(f"async guard:  {rate:10.1f} events/s")
+
+    try:
+        import nest_asyncio
+    except ImportError:
+        print("legacy guard: skipped (nest_asyncio is not installed)")
+        return
+
+    nest_asyncio.apply()
+    rate = await dispatch(legacy_authorized(handler), args.events, args.concurrency, args.sockets)
+    print(f"legacy guard: {rate:10.1f} events/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--sockets", type=int, default=100, help="connections the events are spread over")
+    parser.add_argument("--latency", type=float, default=2, help="simulated DB latency, ms")
+    asyncio.run(run(parser.parse_args()))
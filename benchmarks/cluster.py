@@ -0,0 +1,141 @@
+"""
+Cross-worker check of the Redis cluster backend against the local Redis stand-in.
+
+Starts ``--workers`` Socket.IO servers with the client manager of app.cluster, connects
+``--clients`` sockets to them round robin into one room and emits ``--events`` events to the
+room from the first worker. Every socket must receive every event, whichever worker holds it.
+Then checks that the session store and the broker are shared between the workers.
+
+Usage: python -m benchmarks.cluster --workers 3 --clients 30 --events 20
+"""
+import argparse
+import asyncio
+import inspect
+import statistics
+import sys
+import time
+
+import socketio
+import uvicorn
+from redis import asyncio as aioredis
+
+from app.cluster import RedisBroker, RedisSessionStore, install_client_manager
+from benchmarks.stubs import RedisStub
+
+CHANNEL = "nika-bench"
+ROOM = "room"
+
+
+async def start_worker(redis_url: str) -> tuple[socketio.AsyncServer, uvicorn.Server, str]:
+    server = socketio.AsyncServer(async_mode="asgi")
+    install_client_manager(server, socketio.AsyncRedisManager(redis_url, channel=f"{CHANNEL}:socketio"))
+
+    @server.on("connect")
+    async def on_connect(sid, environ, auth=None):
+        result = server.enter_room(sid, ROOM)
+        if inspect.isawaitable(result):
+            await result
+
+    http = uvicorn.Server(uvicorn.Config(socketio.ASGIApp(server), host="127.0.0.1", port=0, log_level="warning"))
+    asyncio.create_task(http.serve())
+    while not http.started:
+        await asyncio.sleep(0.01)
+
+    port = http.servers[0].sockets[0].getsockname()[1]
+    return server, http, f"http://127.0.0.1:{port}"
+
+
+async def check_rooms(args, redis_url: str) -> bool:
+    workers = [await start_worker(redis_url) for _ in range(args.workers)]
+    received: list[list[float]] = []
+    clients = []
+
+    for i in range(args.clients):
+        client = socketio.AsyncClient()
+        latencies = []
+
+        @client.on("ping")
+        async def on_ping(sent, latencies=latencies):
+            latencies.append(time.time() - sent)
+
+        await client.connect(workers[i % args.workers][2], transports=["websocket"])
+        clients.append(client)
+        received.append(latencies)
+
+    # Room membership of the other workers is not known to the emitter, give the subscriptions a moment
+    await asyncio.sleep(0.5)
+
+    for _ in range(args.events):
+        await workers[0][0].emit("ping", time.time(), room=ROOM)
+    await asyncio.sleep(1)
+
+    delivered = sum(len(latencies) for latencies in received)
+    expected = args.clients * args.events
+    latencies = sorted(latency for client in received for latency in client)
+
+    print(f"room emits: {delivered}/{expected} delivered across {args.workers} workers")
+    if latencies:
+        print(f"  latency p50 {statistics.median(latencies) * 1000:.2f} ms, "
+              f"max {latencies[-1] * 1000:.2f} ms")
+
+    for client in clients:
+        await client.disconnect()
+    for _, http, _ in workers:
+        http.should_exit = True
+
+    return delivered == expected
+
+
+async def check_sessions(redis_url: str) -> bool:
+    first = RedisSessionStore(aioredis.from_url(redis_url), CHANNEL, ttl=60)
+    second = RedisSessionStore(aioredis.from_url(redis_url), CHANNEL, ttl=60)
+
+    await first.save("sid", {"token": "token", "phone": "88005553535", "can_send": False})
+    shared = await second.get("sid") == {"token": "token", "phone": "88005553535", "can_send": False}
+    await second.delete("sid")
+    deleted = await first.get("sid") == {}
+
+    print(f"sessions: shared {shared}, deleted {deleted}")
+    return shared and deleted
+
+
+async def check_broker(args, redis_url: str) -> bool:
+    brokers = [RedisBroker(aioredis.from_url(redis_url), f"{CHANNEL}:broker") for _ in range(args.workers)]
+    received = [[] for _ in brokers]
+
+    for broker, messages in zip(brokers, received):
+        broker.subscribe("user", messages.append)
+        await broker.start()
+    await asyncio.sleep(0.2)
+
+    await brokers[0].publish("user", "6ad4f80b551acde2cae1d9da")
+    await asyncio.sleep(0.2)
+
+    for broker in brokers:
+        await broker.stop()
+
+    others = all(messages == ["6ad4f80b551acde2cae1d9da"] for messages in received[1:])
+    print(f"broker: delivered to the other workers {others}, skipped by the publisher {not received[0]}")
+    return others and not received[0]
+
+
+async def run(args) -> int:
+    stub = RedisStub()
+    redis_url = await stub.start()
+
+    results = [
+        await check_rooms(args, redis_url),
+        await check_sessions(redis_url),
+        await check_broker(args, redis_url),
+    ]
+
+    await stub.stop()
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--clients", type=int, default=30)
+    parser.add_argument("--events", type=int, default=20)
+    sys.exit(asyncio.run(run(parser.parse_args())))
@@ -0,0 +1,61 @@
+"""
+Time to first token of streamed ChatGPT answers against a local fake OpenAI endpoint.
+
+Runs ``--requests`` concurrent completions through gpt.complete (the whole answer at once)
+and gpt.stream (add_message_chunk mode) and reports when the first text becomes available.
+
+Usage: python -m benchmarks.gpt_stream --requests 20 --words 100
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from app.ai.backends import OpenAIBackend
+from app.ai.chatgpt import gpt
+from benchmarks.stubs import OpenAIStub, start_in_thread
+from benchmarks.util import percentile
+
+
+async def measure_complete(messages) -> tuple[float, float]:
+    started = time.perf_counter()
+    await gpt.complete(messages)
+    elapsed = time.perf_counter() - started
+    return elapsed, elapsed
+
+
+async def measure_stream(messages) -> tuple[float, float]:
+    started = time.perf_counter()
+    first = None
+    async for _ in gpt.stream(messages):
+        if first is None:
+            first = time.perf_counter() - started
+    return first, time.perf_counter() - started
+
+
+async def run(args):
+    stub = OpenAIStub(words=args.words, first_token=args.first_token / 1000, token_delay=args.token_delay / 1000)
+    gpt.backend = OpenAIBackend(api_base=start_in_thread(stub))
+    messages = [{"role": "user", "content": "Привет"}]
+
+    report = {}
+    for name, measure in (("complete", measure_complete), ("stream", measure_stream)):
+        results = await asyncio.gather(*(measure(messages) for _ in range(args.requests)))
+        ttft = [r[0] for r in results]
+        total = [r[1] for r in results]
+        report[name] = {
+            "ttft_p50_ms": round(percentile(ttft, 0.5) * 1000, 1),
+            "ttft_p99_ms": round(percentile(ttft, 0.99) * 1000, 1),
+            "total_p50_ms": round(percentile(total, 0.5) * 1000, 1),
+        }
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--words", type=int, default=100)
+    parser.add_argument("--first-token", type=float, default=300, help="ms before the first token")
+    parser.add_argument("--token-delay", type=float, default=20, help="ms between tokens")
+    asyncio.run(run(parser.parse_args()))
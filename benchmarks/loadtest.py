@@ -0,0 +1,256 @@
+"""
+Socket.IO load test of a running server.
+
+Every virtual user is a socketio.AsyncClient walking the flow of client.py: connect, auth,
+auth_confirm with the code read back from the SMS gateway stub, set_name, then ``--messages``
+rounds of add_message and get_messages, and disconnect. ``--users`` clients are started
+evenly over ``--ramp`` seconds and run concurrently.
+
+The SMS gateway stub runs in this process. The server must send SMS to it and answer with
+the stub LLM backend:
+
+    SMS_SERVER=<printed stub url> LLM_BACKEND=stub uvicorn app.main:app
+
+``--spawn`` starts such a server as a subprocess instead. The report is JSON (throughput,
+p50/p95/p99 and error rate per event) so runs can be compared across commits.
+
+Usage: python -m benchmarks.loadtest --spawn --users 1000 --ramp 10 --messages 3 --output load.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Optional
+
+import aiohttp
+import socketio
+
+from benchmarks.stubs import SMSGatewayStub, start_in_thread
+from benchmarks.util import percentile
+
+
+class Recorder:
+    """
+    Latencies and failures per event
+    """
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    def ok(self, event: str, latency: float) -> None:
+        self.latencies[event].append(latency)
+
+    def error(self, event: str, reason: str) -> None:
+        self.errors[event][reason] += 1
+
+    def report(self, elapsed: float) -> dict:
+        events = {}
+        for event in sorted(set(self.latencies) | set(self.errors)):
+            latencies = self.latencies[event]
+            errors = sum(self.errors[event].values())
+            total = len(latencies) + errors
+
+            events[event] = {
+                "count": total,
+                "per_second": round(total / elapsed, 1),
+                "error_rate": round(errors / total, 4),
+                "errors": dict(self.errors[event]),
+                **{f"p{round(p * 100)}_ms": round(percentile(latencies, p) * 1000, 1) for p in (0.5, 0.95, 0.99)}
+            }
+
+        return events
+
+
+class FlowError(Exception):
+    pass
+
+
+class VirtualUser:
+    def __init__(self, args, recorder: Recorder, sms: SMSGatewayStub, phone: str):
+        self.args = args
+        self.recorder = recorder
+        self.sms = sms
+        self.phone = phone
+
+        self.client = socketio.AsyncClient(reconnection=False)
+        self.sms_status = asyncio.Event()
+        self.sms_status_data = {}
+        self.client.on("sms_status", self._on_sms_status)
+
+    async def _on_sms_status(self, data):
+        self.sms_status_data = data
+        self.sms_status.set()
+
+    async def call(self, event: str, data: Optional[dict] = None) -> dict:
+        started = time.perf_counter()
+        try:
+            response = await self.client.call(event, data or {}, timeout=self.args.timeout)
+        except socketio.exceptions.TimeoutError:
+            self.recorder.error(event, "timeout")
+            raise FlowError(event)
+        except socketio.exceptions.SocketIOError as e:
+            # BadNamespaceError once the server has dropped the connection
+            self.recorder.error(event, type(e).__name__)
+            raise FlowError(event)
+
+        if not isinstance(response, dict):
+            self.recorder.error(event, "no response" if response is None else "invalid response")
+            raise FlowError(event)
+
+        if response.get("status") != 200:
+            self.recorder.error(event, str(response.get("status")))
+            raise FlowError(event)
+
+        self.recorder.ok(event, time.perf_counter() - started)
+        return response
+
+    async def connect(self) -> None:
+        started = time.perf_counter()
+        try:
+            await self.client.connect(self.args.url, transports=["websocket"], wait_timeout=self.args.timeout)
+        except socketio.exceptions.ConnectionError as e:
+            self.recorder.error("connect", type(e).__name__)
+            raise FlowError("connect")
+
+        self.recorder.ok("connect", time.perf_counter() - started)
+
+    async def read_code(self) -> str:
+        """
+        Wait for the delivery report and take the code the server sent to the gateway stub
+
+        :return:
+        """
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.sms_status.wait(), self.args.timeout)
+        except asyncio.TimeoutError:
+            self.recorder.error("sms", "timeout")
+            raise FlowError("sms")
+
+        code = self.sms.messages.get(self.phone)
+        if self.sms_status_data.get("status") != 200 or code is None:
+            self.recorder.error("sms", str(self.sms_status_data.get("status")))
+            raise FlowError("sms")
+
+        self.recorder.ok("sms", time.perf_counter() - started)
+        return code
+
+    async def run(self) -> bool:
+        try:
+            await self.connect()
+
+            await self.call("auth", {"phone": self.phone})
+            await self.call("auth_confirm", {"code": await self.read_code()})
+            await self.call("set_name", {"name": "Ника"})
+
+            for i in range(self.args.messages):
+                await self.call("add_message", {"text": f"Вопрос {i}"})
+                await self.call("get_messages", {"limit": 20})
+
+            return True
+        except FlowError:
+            return False
+        finally:
+            await self.client.disconnect()
+
+
+async def wait_for_server(url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(f"{url}/docs"):
+                    return
+            except aiohttp.ClientConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+
+def spawn_server(args, sms_url: str) -> subprocess.Popen:
+    env = {**os.environ, "SMS_SERVER": sms_url, "LLM_BACKEND": "stub"}
+    port = args.url.rsplit(":", 1)[1]
+
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", port, "--log-level", "warning"],
+        env=env,
+        stdout=subprocess.DEVNULL
+    )
+
+
+def current_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    sms = SMSGatewayStub(latency=args.sms_latency / 1000)
+    sms_url = start_in_thread(sms, port=args.sms_port)
+
+    server = None
+    if args.spawn:
+        server = spawn_server(args, sms_url)
+    else:
+        print(f"Expecting the server at {args.url} with SMS_SERVER={sms_url} LLM_BACKEND=stub", file=sys.stderr)
+
+    try:
+        await wait_for_server(args.url, args.timeout)
+
+        recorder = Recorder()
+        users = [VirtualUser(args, recorder, sms, str(args.first_phone + i)) for i in range(args.users)]
+        interval = args.ramp / args.users
+
+        async def start(i: int, user: VirtualUser) -> bool:
+            await asyncio.sleep(i * interval)
+            return await user.run()
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(start(i, user) for i, user in enumerate(users)), return_exceptions=True)
+        elapsed = time.perf_counter() - started
+
+        # Failures outside the recorded events, counted instead of aborting the run
+        for result in results:
+            if isinstance(result, BaseException):
+                recorder.error("flow", type(result).__name__)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    return {
+        "commit": current_commit(),
+        "users": args.users,
+        "messages": args.messages,
+        "completed": sum(result is True for result in results),
+        "elapsed_s": round(elapsed, 2),
+        "events": recorder.report(elapsed),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--spawn", action="store_true", help="start the server with the stubs configured")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--ramp", type=float, default=5, help="seconds over which the users are started")
+    parser.add_argument("--messages", type=int, default=3, help="add_message/get_messages rounds per user")
+    parser.add_argument("--first-phone", type=int, default=89000000000)
+    parser.add_argument("--sms-port", type=int, default=9100, help="SMS gateway stub port, 0 picks a free one")
+    parser.add_argument("--sms-latency", type=float, default=100, help="ms")
+    parser.add_argument("--timeout", type=float, default=60, help="per event, s")
+    parser.add_argument("--output", help="also write the report to this file")
+    args = parser.parse_args()
+
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    print(report)
@@ -0,0 +1,67 @@
+"""
+Promocode allocation under a signup spike.
+
+``--signups`` concurrent PromocodeAllocator.allocate calls against a local mongod, starting with
+an empty pool. Reports allocation throughput, latency percentiles and collisions as JSON.
+``--length`` shortens the codes to force collisions. Uses a throwaway database which is dropped afterwards.
+
+Usage: python -m benchmarks.promocodes --signups 5000 --batch 200 --length 3
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from beanie import init_beanie
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from app.auth.models.user import User
+from app.database import DATABASE_URI
+from app.metrics import metrics
+from app.payments.models import PromocodeReservation
+from app.payments.promocode import PromocodeAllocationFailed, PromocodeAllocator
+from benchmarks.util import percentile
+
+
+async def run(args) -> dict:
+    client = AsyncIOMotorClient(args.uri)
+    await init_beanie(database=client[args.database], document_models=[User, PromocodeReservation])
+
+    allocator = PromocodeAllocator(batch=args.batch, low_water=args.batch // 4, length=args.length)
+    latencies, failed = [], 0
+
+    async def signup():
+        nonlocal failed
+        started = time.perf_counter()
+        try:
+            await allocator.allocate()
+        except PromocodeAllocationFailed:
+            failed += 1
+        latencies.append(time.perf_counter() - started)
+
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(signup() for _ in range(args.signups)))
+        elapsed = time.perf_counter() - started
+    finally:
+        await client.drop_database(args.database)
+
+    snapshot = metrics.snapshot()
+    return {
+        "signups": args.signups,
+        "failed": failed,
+        "allocations_per_second": round(args.signups / elapsed, 1),
+        "reserved": snapshot.get("promocode.allocator.reserved", 0),
+        "collisions": snapshot.get("promocode.allocator.collisions", 0),
+        **{f"p{round(p * 100)}_ms": round(percentile(latencies, p) * 1000, 2) for p in (0.5, 0.95, 0.99)}
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uri", default=DATABASE_URI)
+    parser.add_argument("--database", default="nika_promocodes")
+    parser.add_argument("--signups", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=200)
+    parser.add_argument("--length", type=int, default=10)
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2))
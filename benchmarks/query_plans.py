@@ -0,0 +1,120 @@
+"""
+Explain-plan check for chat and auth queries.
+
+Builds every hot query from the same beanie expressions the app uses, runs ``explain`` against
+a local mongod and fails if any winning plan scans a whole collection (COLLSCAN).
+Uses a throwaway database which is dropped afterwards.
+
+Usage: python -m benchmarks.query_plans [--uri mongodb://localhost:27017]
+"""
+import argparse
+import asyncio
+import sys
+from datetime import datetime, timedelta
+
+import pymongo
+from beanie import PydanticObjectId, init_beanie
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from app.auth.models.auth import RevokedToken, Tokens
+from app.auth.models.limits import Limit
+from app.auth.models.user import User, UserAuthCode
+from app.chat.models import Message
+from app.database import DATABASE_URI
+from app.payments.models import Order, Tariff
+
+
+def queries(user_id: PydanticObjectId, msg_id: PydanticObjectId) -> dict:
+    """
+    name -> (document, filter, sort) of the queries the app runs
+    """
+    now = datetime.utcnow()
+    newest_first = [("_id", pymongo.DESCENDING)]
+
+    return {
+        # app/chat
+        "chat.get_all_messages": (Message, Message.find(Message.user.id == user_id).get_filter_query(), None),
+        "chat.get_message": (Message, Message.find(Message.user.id == user_id, Message.id == msg_id)
+                             .get_filter_query(), None),
+        "chat.get_last_turns": (Message, Message.find(Message.user.id == user_id).get_filter_query(), newest_first),
+        "chat.page_before": (Message, Message.find(Message.user.id == user_id, Message.id < msg_id)
+                             .get_filter_query(), newest_first),
+        "chat.page_after": (Message, Message.find(Message.user.id == user_id, Message.id > msg_id)
+                            .get_filter_query(), [("_id", pymongo.ASCENDING)]),
+        # app/auth
+        "tokens.by_access_token": (Tokens, Tokens.find(Tokens.access_token == "token").get_filter_query(), None),
+        "tokens.by_refresh_token": (Tokens, Tokens.find(Tokens.refresh_token == "token").get_filter_query(), None),
+        "tokens.by_user": (Tokens, Tokens.find(Tokens.user.id == user_id).get_filter_query(), None),
+        "revoked.refresh": (RevokedToken, RevokedToken.find(RevokedToken.expire > now,
+                                                            RevokedToken.id >= ObjectId.from_datetime(now))
+                            .get_filter_query(), None),
+        "user.by_phone": (User, User.find(User.phone == "88005553535").get_filter_query(), None),
+        "user.by_promocode": (User, User.find(User.promocode == "promocode").get_filter_query(), None),
+        "code.by_code": (UserAuthCode, UserAuthCode.find(UserAuthCode.code == "123456").get_filter_query(), None),
+        "code.by_phone": (UserAuthCode, UserAuthCode.find(UserAuthCode.phone == "88005553535")
+                          .get_filter_query(), None),
+        "code.expired": (UserAuthCode, {"expire": {"$lte": now}}, None),
+        "limit.by_phone": (Limit, Limit.find(Limit.phone == "88005553535").get_filter_query(), None),
+        "limit.expired": (Limit, {"expire": {"$lte": now}}, None),
+        "tariff.by_name": (Tariff, Tariff.find(Tariff.name == "month").get_filter_query(), None),
+    }
+
+
+def stages(plan: dict):
+    yield plan.get("stage")
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from stages(child)
+
+
+async def seed(user: User) -> PydanticObjectId:
+    await Message.insert_many([Message(role="user", content=str(i), user=user) for i in range(50)])
+    msg = Message(role="assistant", content="last", user=user)
+    await msg.create()
+    await Limit(phone=user.phone).create()
+    await UserAuthCode(phone=user.phone, code="123456", expire=datetime.utcnow() + timedelta(minutes=10)).create()
+    return msg.id
+
+
+async def run(args) -> int:
+    client = AsyncIOMotorClient(args.uri)
+    database = client[args.database]
+    await init_beanie(database=database, document_models=[UserAuthCode, User, Message, Tokens, RevokedToken,
+                                                          Limit, Tariff, Order])
+
+    try:
+        user = User(phone="88005553535", promocode="promocode")
+        await user.create()
+        msg_id = await seed(user)
+
+        failed = []
+        for name, (document, query, sort) in queries(user.id, msg_id).items():
+            cursor = document.get_motor_collection().find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+
+            plan = (await cursor.explain())["queryPlanner"]["winningPlan"]
+            used = [stage for stage in stages(plan) if stage]
+            status = "COLLSCAN" if "COLLSCAN" in used else "ok"
+            print(f"{status:8} {name:28} {' <- '.join(used)}")
+
+            if status != "ok":
+                failed.append(name)
+    finally:
+        await client.drop_database(args.database)
+
+    if failed:
+        print(f"\n{len(failed)} queries regressed to COLLSCAN: {', '.join(failed)}")
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uri", default=DATABASE_URI)
+    parser.add_argument("--database", default="nika_query_plans")
+    sys.exit(asyncio.run(run(parser.parse_args())))
@@ -0,0 +1,137 @@
+"""
+Read routing check against a local replica set.
+
+Runs the routed reads of the app (chat history, catalog lookups, auth) through the real functions
+and records which member answered each of them with a pymongo command listener. Fails if an auth
+read left the primary, or if a secondary-reading profile was served by the primary while healthy
+secondaries were available. Uses a throwaway database which is dropped afterwards.
+
+A replica set for the check:
+
+    mongod --replSet rs0 --port 27017 --dbpath /tmp/rs0-0 &
+    mongod --replSet rs0 --port 27018 --dbpath /tmp/rs0-1 &
+    mongosh --eval 'rs.initiate({_id: "rs0", members: [{_id: 0, host: "localhost:27017"},
+                                                       {_id: 1, host: "localhost:27018"}]})'
+
+The profiles read from the primary by default, secondary routing is checked with e.g.
+
+    DB_READ_CHAT=secondaryPreferred DB_READ_CATALOG=secondaryPreferred python -m benchmarks.read_routing
+
+Usage: python -m benchmarks.read_routing --uri "mongodb://localhost:27017,localhost:27018/?replicaSet=rs0"
+"""
+import argparse
+import asyncio
+import sys
+from datetime import datetime, timedelta
+
+from beanie import init_beanie
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+from pymongo.read_preferences import Primary
+
+import app.auth.tokens as token_auth
+import app.auth.utils.sms as sms
+import app.chat.chat as chat
+import app.database as db
+import app.payments.promocode as promo
+from app.auth.models.auth import RevokedToken, Tokens
+from app.auth.models.limits import Limit
+from app.auth.models.user import User, UserAuthCode
+from app.chat.models import Message
+from app.payments.catalog import tariff_catalog
+from app.payments.models import Order, Tariff
+
+READ_COMMANDS = {"find", "aggregate", "count"}
+
+
+class ServedBy(monitoring.CommandListener):
+    """
+    Remembers the member that answered the last read command
+    """
+
+    def __init__(self):
+        self.address = None
+
+    def started(self, event):
+        if event.command_name in READ_COMMANDS and event.database_name != "admin":
+            self.address = event.connection_id
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+async def run(args) -> int:
+    served_by = ServedBy()
+    # The app's client, with the listener: routed reads go through db.get_client()
+    db.client = AsyncIOMotorClient(args.uri, event_listeners=[served_by], w="majority")
+    await init_beanie(database=db.client[args.database],
+                      document_models=[UserAuthCode, User, Message, Tokens, RevokedToken, Limit, Tariff, Order])
+
+    await db.client.admin.command("ping")
+    primary = db.client.primary
+    secondaries = db.client.secondaries
+    print(f"primary {primary[0]}:{primary[1]}, secondaries {', '.join(f'{h}:{p}' for h, p in secondaries) or '-'}")
+
+    failed = []
+    try:
+        user = User(phone="89000000001", tariff="month", promocode="routing")
+        await user.create()
+        await Tariff(name="month", sum=299).create()
+        await chat.add_messages(user, [{"message": f"m{i}", "role": "user"} for i in range(10)])
+        await UserAuthCode(code="123456", phone=user.phone, expire=datetime.utcnow() + timedelta(minutes=10),
+                           can_send=datetime.utcnow()).create()
+        tokens = await token_auth.create_tokens(user)
+        await Tokens(**tokens.dict(), user=user).create()
+
+        reads = {
+            "chat": {
+                "get_messages_selection": lambda: chat.get_messages_selection(user, 0, 5, raw=True),
+                "get_messages_page": lambda: chat.get_messages_page(user, limit=5),
+                "get_messages_count": lambda: chat.get_messages_count(user),
+            },
+            "catalog": {
+                "get_promocode": lambda: promo.get_promocode(user.promocode),
+                "tariff_catalog.load": lambda: tariff_catalog.load(),
+            },
+            "primary": {
+                "get_code": lambda: sms.get_code("123456"),
+                "get_db_token": lambda: token_auth.get_db_token(tokens.access_token),
+            },
+        }
+
+        for profile, functions in reads.items():
+            on_primary = isinstance(db.READ_PROFILES[profile], Primary)
+
+            for name, read in functions.items():
+                served_by.address = None
+                await read()
+
+                member = "primary" if served_by.address == primary else "secondary"
+                status = "ok"
+                if on_primary and member != "primary":
+                    status = "LEAKED"
+                elif not on_primary and secondaries and member == "primary" \
+                        and db.READ_PROFILES[profile].mongos_mode.startswith("secondary"):
+                    status = "PRIMARY"
+
+                print(f"{status:8} {profile:8} {name:24} {member} {served_by.address[0]}:{served_by.address[1]}")
+                if status != "ok":
+                    failed.append(name)
+    finally:
+        await db.client.drop_database(args.database)
+
+    if failed:
+        print(f"\n{len(failed)} reads went to the wrong member: {', '.join(failed)}")
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uri", default="mongodb://localhost:27017,localhost:27018/?replicaSet=rs0")
+    parser.add_argument("--database", default="nika_read_routing")
+    sys.exit(asyncio.run(run(parser.parse_args())))
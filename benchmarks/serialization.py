@@ -0,0 +1,100 @@
+"""
+Encoding cost of WSResponse payloads.
+
+Compares jsonable_encoder with the precompiled serializers of app.schemas on history pages
+of ``--messages`` ChatMessages and on the auth payload (User and Tokens), both alone and
+followed by the json.dumps that python-socketio does before sending.
+
+The last case adds the cost of reading the page: ChatMessage models built from the documents
+of .project(ChatMessage) against the wire-shaped rows of chat.read_messages(raw=True).
+
+Usage: python -m benchmarks.serialization --messages 1000 --rounds 200
+"""
+import argparse
+import json
+import timeit
+from datetime import datetime, timedelta
+
+from beanie import PydanticObjectId
+from fastapi.encoders import jsonable_encoder
+
+import app.main  # noqa: F401, registers the serializers
+from app.auth.models.auth import TokensRead
+from app.auth.models.user import User
+from app.chat.models import ChatMessage
+from app.schemas import WSResponse, encode_response
+
+
+def history_page(messages: int) -> WSResponse:
+    page = []
+    for i in range(messages):
+        msg_id = PydanticObjectId()
+        page.append(ChatMessage(id=str(msg_id), text="Привет, как дела? " * 8, type="user" if i % 2 else "bot",
+                                date=msg_id.generation_time))
+
+    return WSResponse(status=200, type="info", data={"messages": page, "cursor": None})
+
+
+def auth_payload() -> WSResponse:
+    now = datetime.utcnow()
+    # No database here: construct() skips the collection check and the hidden fields are set
+    # by hand, init_beanie does it in the app
+    User._hidden_fields = User.get_hidden_fields()
+    user = User.construct(id=PydanticObjectId(), phone="88005553535", name="Ника", promocode="promocode")
+    tokens = TokensRead(access_token="a" * 160, access_expire=now + timedelta(days=2),
+                        refresh_token="r" * 160, refresh_expire=now + timedelta(days=30))
+
+    return WSResponse(status=200, type="info", data={"user": user, "auth": tokens})
+
+
+def read_path(messages: int, rounds: int) -> None:
+    docs = []
+    for i in range(messages):
+        msg_id = PydanticObjectId()
+        docs.append({"_id": msg_id, "id": msg_id, "type": "user" if i % 2 else "assistant",
+                     "text": "Привет, как дела? " * 8})
+
+    rows = [ChatMessage(**doc).dict() for doc in docs]
+    for row in rows:
+        row["date"] = row["date"].strftime("%Y-%m-%dT%H:%M:%S+00:00")
+
+    def models():
+        page = [ChatMessage(**doc) for doc in docs]
+        return encode_response(WSResponse(status=200, type="info", data={"messages": page, "cursor": None}))
+
+    def raw():
+        return encode_response(WSResponse(status=200, type="info", data={"messages": rows, "cursor": None}))
+
+    assert models() == raw(), "read paths disagree"
+
+    print(f"history page read, {messages} messages")
+    for case, func in {"models": models, "raw rows": raw}.items():
+        seconds = min(timeit.repeat(func, number=rounds, repeat=3)) / rounds
+        print(f"  {case:26} {seconds * 1000:9.3f} ms/op")
+
+
+def measure(name: str, response: WSResponse, rounds: int) -> None:
+    assert jsonable_encoder(response) == encode_response(response), f"{name}: encoders disagree"
+
+    cases = {
+        "jsonable_encoder": lambda: jsonable_encoder(response),
+        "encode_response": lambda: encode_response(response),
+        "jsonable_encoder + dumps": lambda: json.dumps(jsonable_encoder(response)),
+        "encode_response + dumps": lambda: json.dumps(encode_response(response)),
+    }
+
+    print(name)
+    for case, func in cases.items():
+        seconds = min(timeit.repeat(func, number=rounds, repeat=3)) / rounds
+        print(f"  {case:26} {seconds * 1000:9.3f} ms/op")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    measure(f"history page, {args.messages} messages", history_page(args.messages), args.rounds)
+    measure("auth payload", auth_payload(), args.rounds * 50)
+    read_path(args.messages, args.rounds)
@@ -0,0 +1,75 @@
+"""
+Latency of concurrent events while SMS sends are in flight.
+
+Starts a local SMS gateway stub in a separate thread, fires ``--sends`` concurrent SMSApi.send calls and, at the same
+time, measures how long lightweight events wait for the event loop. ``--blocking`` runs the sends
+through the old blocking ``requests.get`` for comparison.
+
+Usage: python -m benchmarks.sms_gateway --sends 200 --latency 50
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from app.auth.sms_api import SMSApi, SMSResponse
+from benchmarks.stubs import SMSGatewayStub, start_in_thread
+from benchmarks.util import percentile
+
+
+async def blocking_send(api: SMSApi, phone: str, message: str) -> SMSResponse:
+    import requests
+
+    params = {"method": "push_msg", "format": "json", "key": api.key, "text": message, "phone": phone}
+    return SMSResponse(data=requests.get(api.sms_server, params=params).json())
+
+
+async def probe_events(stop: asyncio.Event, interval: float, lags: list[float]):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def run(args):
+    stub = SMSGatewayStub(latency=args.latency / 1000)
+    api = SMSApi(sms_server=start_in_thread(stub))
+
+    send_latencies, lags = [], []
+    stop = asyncio.Event()
+    probe = asyncio.create_task(probe_events(stop, 0.001, lags))
+
+    async def one(i):
+        started = time.perf_counter()
+        phone = f"8900{i:07d}"
+        if args.blocking:
+            await blocking_send(api, phone, "1234")
+        else:
+            await api.send(phone, "1234")
+        send_latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.sends)))
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await probe
+    await api.close()
+
+    print(json.dumps({
+        "backend": "blocking" if args.blocking else "async",
+        "sends": args.sends,
+        "elapsed_s": round(elapsed, 3),
+        "send_p50_ms": round(percentile(send_latencies, 0.5) * 1000, 2),
+        "send_p99_ms": round(percentile(send_latencies, 0.99) * 1000, 2),
+        "event_lag_p50_ms": round(percentile(lags, 0.5) * 1000, 2),
+        "event_lag_p99_ms": round(percentile(lags, 0.99) * 1000, 2),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sends", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=50, help="gateway latency, ms")
+    parser.add_argument("--blocking", action="store_true", help="send with blocking requests.get")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,262 @@
+"""
+Local stand-ins for external services used by the benchmarks.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+
+from aiohttp import web
+
+
+class SMSGatewayStub:
+    """
+    Mimics api.sms-prosto.ru push_msg. Remembers the last message per phone so
+    load tests can read verification codes back from ``GET /codes/{phone}``
+    """
+
+    def __init__(self, latency: float = 0.1, jitter: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.messages: dict[str, str] = {}
+        self.sent = 0
+
+        self.app = web.Application()
+        self.app.router.add_get("/", self.push_msg)
+        self.app.router.add_get("/codes/{phone}", self.get_code)
+        self._runner = None
+
+    async def push_msg(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+        if random.random() < self.error_rate:
+            return web.Response(status=503)
+
+        self.messages[request.query["phone"]] = request.query["text"]
+        self.sent += 1
+        return web.json_response({"response": {"msg": {"err_code": "0", "text": "OK", "type": "message"}}})
+
+    async def get_code(self, request: web.Request) -> web.Response:
+        code = self.messages.get(request.match_info["phone"])
+        if code is None:
+            raise web.HTTPNotFound()
+        return web.json_response({"code": code})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+
+class OpenAIStub:
+    """
+    Mimics POST /chat/completions of the OpenAI API, including ``stream=True`` server-sent events.
+    Answers with ``words`` words after ``first_token`` seconds, ``token_delay`` seconds apart
+    """
+
+    def __init__(self, words: int = 50, first_token: float = 0.3, token_delay: float = 0.02):
+        self.words = words
+        self.first_token = first_token
+        self.token_delay = token_delay
+
+        self.app = web.Application()
+        self.app.router.add_post("/v1/chat/completions", self.chat_completions)
+        self._runner = None
+
+    def _tokens(self) -> list[str]:
+        return [f"слово{i} " for i in range(self.words)]
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        await asyncio.sleep(self.first_token)
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.token_delay * (self.words - 1))
+            return web.json_response({
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "model": body["model"],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(self._tokens())}}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": self.words, "total_tokens": self.words},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        for i, token in enumerate(self._tokens()):
+            if i:
+                await asyncio.sleep(self.token_delay)
+            chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "model": body["model"],
+                     "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}/v1"
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+
+class RedisStub:
+    """
+    In-memory Redis speaking enough of RESP2 for the cluster backend: GET, SET with EX, DEL,
+    PUBLISH and SUBSCRIBE. Several workers connected to one stub see each other's messages
+    """
+
+    class _Status(str):
+        pass
+
+    def __init__(self):
+        self.values: dict[bytes, tuple[bytes, float]] = {}
+        self.channels: dict[bytes, set[asyncio.StreamWriter]] = {}
+        self.published = 0
+        self._server = None
+        self._connections: set[asyncio.Task] = set()
+
+    @classmethod
+    def _encode(cls, value) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, cls._Status):
+            return f"+{value}\r\n".encode()
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, str):
+            value = value.encode()
+        if isinstance(value, bytes):
+            return b"$%d\r\n%s\r\n" % (len(value), value)
+        return b"*%d\r\n" % len(value) + b"".join(cls._encode(item) for item in value)
+
+    @staticmethod
+    async def _read_command(reader: asyncio.StreamReader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if line[:1] != b"*":
+            return line.split()
+
+        args = []
+        for _ in range(int(line[1:])):
+            size = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(size + 2))[:-2])
+        return args
+
+    def _get(self, key: bytes):
+        value, deadline = self.values.get(key, (None, 0))
+        if deadline and deadline < time.monotonic():
+            del self.values[key]
+            return None
+        return value
+
+    def _execute(self, command: bytes, args: list[bytes]):
+        if command == b"PING":
+            return self._Status("PONG")
+        if command in (b"SELECT", b"CLIENT"):
+            return self._Status("OK")
+        if command == b"GET":
+            return self._get(args[0])
+        if command == b"SET":
+            deadline = 0
+            if len(args) > 3 and args[2].upper() == b"EX":
+                deadline = time.monotonic() + int(args[3])
+            self.values[args[0]] = (args[1], deadline)
+            return self._Status("OK")
+        if command == b"DEL":
+            return sum(self.values.pop(key, None) is not None for key in args)
+        if command == b"PUBLISH":
+            subscribers = self.channels.get(args[0], set())
+            for subscriber in subscribers:
+                subscriber.write(self._encode([b"message", args[0], args[1]]))
+            self.published += 1
+            return len(subscribers)
+        raise ValueError(f"unknown command '{command.decode()}'")
+
+    def _subscriptions(self, writer: asyncio.StreamWriter) -> list[bytes]:
+        return [channel for channel, subscribers in self.channels.items() if writer in subscribers]
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._connections.add(task)
+
+        try:
+            while (args := await self._read_command(reader)) is not None:
+                command, args = args[0].upper(), args[1:]
+
+                if command == b"SUBSCRIBE":
+                    for channel in args:
+                        self.channels.setdefault(channel, set()).add(writer)
+                        writer.write(self._encode([b"subscribe", channel, len(self._subscriptions(writer))]))
+                elif command == b"UNSUBSCRIBE":
+                    for channel in args or self._subscriptions(writer) or [None]:
+                        self.channels.get(channel, set()).discard(writer)
+                        writer.write(self._encode([b"unsubscribe", channel, len(self._subscriptions(writer))]))
+                else:
+                    try:
+                        writer.write(self._encode(self._execute(command, args)))
+                    except ValueError as e:
+                        writer.write(f"-ERR {e}\r\n".encode())
+
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            for subscribers in self.channels.values():
+                subscribers.discard(writer)
+            writer.close()
+            self._connections.discard(task)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._server = await asyncio.start_server(self._serve, host, port)
+        port = self._server.sockets[0].getsockname()[1]
+        return f"redis://{host}:{port}/0"
+
+    async def stop(self) -> None:
+        if self._server:
+            self._server.close()
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+
+
+def start_in_thread(stub, port: int = 0) -> str:
+    """
+    Runs a stub on its own event loop in a daemon thread, so it keeps answering
+    even when the measured code blocks its loop
+
+    :param stub:
+    :param port: 0 picks a free port
+    :return: stub url
+    """
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    result = {}
+
+    def run():
+        asyncio.set_event_loop(loop)
+        result["url"] = loop.run_until_complete(stub.start(port=port))
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    return result["url"]
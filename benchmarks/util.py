@@ -0,0 +1,8 @@
+"""
+Helpers shared by the benchmarks.
+"""
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0